@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
-import argparse
-import tempfile
+# Slow-to-import modules (argparse, re, tempfile, hashlib, collections) are
+# imported lazily, on the code paths that need them, since asm-processor is
+# invoked several times per source file during a build.
 import struct
-import copy
+import bisect
+import mmap
+import time
 import sys
-import re
 import os
-from collections import namedtuple
 from io import StringIO
 
 MAX_FN_SIZE = 100
+JTBL_INSTR_COUNT = 9
+# Smallest allowed --max-fn-size: the first generated function must have room
+# for the prologue instructions that can't be replaced (up to 7, see
+# make_global_state), the float that late rodata starts with (3), and a jump
+# table dispatch together with the instruction in its delay slot.
+MIN_MAX_FN_SIZE = 7 + 3 + JTBL_INSTR_COUNT + 1
+# Number of instructions IDO emits per jump table switch statement, for the
+# flags (opt, framepointer) where this has been checked against the compiler.
+# Late rodata is generated using jump tables for these flags only. Add counts
+# found by find-jtbl-instr-count.sh here once they pass the tests.
+JTBL_INSTR_COUNTS = {
+    ('O2', False): JTBL_INSTR_COUNT,
+    ('g3', False): JTBL_INSTR_COUNT,
+}
+# Maximum number of block shapes per file for which finish() remembers the
+# generated C, see FinishTemplate.
+FINISH_TEMPLATE_CACHE_SIZE = 256
 SLOW_CHECKS = False
 
 EI_NIDENT     = 16
@@ -163,6 +181,19 @@ class Relocation:
             return struct.pack('>III', self.r_offset, self.r_info, self.r_addend)
 
 
+def relocations_to_bin(relocations, sh_type):
+    # Encode a whole relocation table with a single struct.pack call.
+    fields = []
+    is_rela = (sh_type != SHT_REL)
+    for rel in relocations:
+        rel.r_info = (rel.sym_index << 8) | rel.rel_type
+        fields.append(rel.r_offset)
+        fields.append(rel.r_info)
+        if is_rela:
+            fields.append(rel.r_addend)
+    return struct.pack('>' + ('III' if is_rela else 'II') * len(relocations), *fields)
+
+
 class Section:
     """
     typedef struct {
@@ -204,8 +235,13 @@ class Section:
 
     def add_str(self, string):
         assert self.sh_type == SHT_STRTAB
+        encoded = string.encode('latin1') + b'\0'
+        # Reuse an existing copy of the string, or a string it is a suffix of.
+        ret = self.data.find(encoded)
+        if ret != -1:
+            return ret
         ret = len(self.data)
-        self.data += string.encode('latin1') + b'\0'
+        self.data += encoded
         return ret
 
     def is_rel(self):
@@ -262,6 +298,35 @@ class Section:
         return self.symbol_entries[self.sh_info:]
 
 
+class StrtabBuilder:
+    """Builds deduplicated string table contents, sharing common suffixes."""
+
+    def __init__(self):
+        self.strings = set()
+
+    def add(self, string):
+        self.strings.add(string)
+
+    def build(self):
+        # Sorting by reversed string puts each string right after the longest
+        # string it is a suffix of, so that it can point into its tail.
+        data = bytearray(b'\0')
+        offsets = {'': 0}
+        prev = None
+        prev_offset = 0
+        for string in sorted(self.strings, key=lambda x: x[::-1], reverse=True):
+            if not string:
+                continue
+            if prev is not None and prev.endswith(string):
+                offsets[string] = prev_offset + len(prev) - len(string)
+                continue
+            prev = string
+            prev_offset = len(data)
+            offsets[string] = prev_offset
+            data += string.encode('latin1') + b'\0'
+        return bytes(data), offsets
+
+
 class ElfFile:
     def __init__(self, data):
         self.data = data
@@ -315,34 +380,55 @@ class ElfFile:
         while self.sections[-1].sh_type in [SHT_MIPS_DEBUG, SHT_MIPS_GPTAB]:
             self.sections.pop()
 
-    def write(self, filename):
-        outfile = open(filename, 'wb')
-        outidx = 0
-        def write_out(data):
-            nonlocal outidx
-            outfile.write(data)
-            outidx += len(data)
+    def to_bin(self):
+        out = bytearray()
         def pad_out(align):
-            if align and outidx % align:
-                write_out(b'\0' * (align - outidx % align))
+            if align and len(out) % align:
+                out.extend(b'\0' * (align - len(out) % align))
 
         self.elf_header.e_shnum = len(self.sections)
-        write_out(self.elf_header.to_bin())
+        out += self.elf_header.to_bin()
 
         for s in self.sections:
             if s.sh_type != SHT_NOBITS and s.sh_type != SHT_NULL:
                 pad_out(s.sh_addralign)
-                s.sh_offset = outidx
-                write_out(s.data)
+                s.sh_offset = len(out)
+                out += s.data
 
         pad_out(4)
-        self.elf_header.e_shoff = outidx
+        self.elf_header.e_shoff = len(out)
         for s in self.sections:
-            write_out(s.header_to_bin())
+            out += s.header_to_bin()
+
+        header = self.elf_header.to_bin()
+        out[:len(header)] = header
+        return bytes(out)
+
+    def write(self, filename):
+        with open(filename, 'wb') as outfile:
+            outfile.write(self.to_bin())
+
 
-        outfile.seek(0)
-        outfile.write(self.elf_header.to_bin())
-        outfile.close()
+class RangeSet:
+    """A set of byte offsets, stored as sorted, disjoint [start, end) ranges."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        if start == end:
+            return
+        assert not self.ends or start >= self.ends[-1], "ranges must be added in order"
+        if self.ends and start == self.ends[-1]:
+            self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __contains__(self, pos):
+        i = bisect.bisect_right(self.starts, pos) - 1
+        return i >= 0 and pos < self.ends[i]
 
 
 def is_temp_name(name):
@@ -358,9 +444,32 @@ def re_comment_replacer(match):
         return s
 
 
-re_comment_or_string = re.compile(
-    r'#.*|/\*.*?\*/|"(?:\\.|[^\\"])*"'
-)
+re_comment_or_string = r'#.*|/\*.*?\*/|"(?:\\.|[^\\"])*"'
+
+
+class Regexes:
+    # Regular expressions used for every line of assembly or C source. These
+    # are compiled once, when first needed (see compiled_regexes), rather than
+    # at import time, since importing re is slow.
+    def __init__(self):
+        import re
+        self.comment_or_string = re.compile(re_comment_or_string)
+        self.label_prefix = re.compile(r'^[a-zA-Z0-9_]+:\s*')
+        self.asm_label = re.compile(r'^([a-zA-Z0-9_.$]+):\s*')
+        self.identifier = re.compile(r'[a-zA-Z_.$][a-zA-Z0-9_.$]*')
+        self.assignment = re.compile(r'^[a-zA-Z_.$][a-zA-Z0-9_.$]*\s*=')
+        self.incbin = re.compile(r'^\s*(?:[a-zA-Z0-9_]+:\s*)?\.incbin\s+"([^"\\]*)"\s*,([^,#]*),([^,#]*?)\s*(?:#.*)?$')
+        self.include = re.compile(r'^\s*(?:[a-zA-Z0-9_]+:\s*)?\.(include|incbin)\s+"([^"\\]*)"')
+        self.cutscene_data = re.compile(cutscene_data_regexpr)
+        self.float = re.compile(float_regexpr)
+
+regexes = None
+
+def compiled_regexes():
+    global regexes
+    if regexes is None:
+        regexes = Regexes()
+    return regexes
 
 
 class Failure(Exception):
@@ -372,7 +481,7 @@ class Failure(Exception):
 
 
 class GlobalState:
-    def __init__(self, min_instr_count, skip_instr_count, use_jtbl_for_rodata):
+    def __init__(self, min_instr_count, skip_instr_count, use_jtbl_for_rodata, max_fn_size=MAX_FN_SIZE, jtbl_instr_count=JTBL_INSTR_COUNT):
         # A value that hopefully never appears as a 32-bit rodata constant (or we
         # miscompile late rodata). Increases by 1 in each step.
         self.late_rodata_hex = 0xE0123456
@@ -380,6 +489,9 @@ class GlobalState:
         self.min_instr_count = min_instr_count
         self.skip_instr_count = skip_instr_count
         self.use_jtbl_for_rodata = use_jtbl_for_rodata
+        self.max_fn_size = max_fn_size
+        self.jtbl_instr_count = jtbl_instr_count
+        self.finish_templates = {}
 
     def next_late_rodata_hex(self):
         dummy_bytes = struct.pack('>I', self.late_rodata_hex)
@@ -389,23 +501,233 @@ class GlobalState:
         self.late_rodata_hex += 1
         return dummy_bytes
 
+    def make_late_rodata_float(self):
+        dummy_bytes = self.next_late_rodata_hex()
+        fval, = struct.unpack('>f', dummy_bytes)
+        return [dummy_bytes], '{}f'.format(fval)
+
+    def make_late_rodata_double(self):
+        dummy_bytes = self.next_late_rodata_hex()
+        dummy_bytes2 = self.next_late_rodata_hex()
+        fval, = struct.unpack('>d', dummy_bytes + dummy_bytes2)
+        return [dummy_bytes, dummy_bytes2], '{}'.format(fval)
+
     def make_name(self, cat):
         self.namectr += 1
         return '_asmpp_{}{}'.format(cat, self.namectr)
 
+    def add_finish_template(self, key, template):
+        if len(self.finish_templates) >= FINISH_TEMPLATE_CACHE_SIZE:
+            if FINISH_TEMPLATE_CACHE_SIZE <= 0:
+                return
+            # Evict the least recently used shape.
+            del self.finish_templates[next(iter(self.finish_templates))]
+        self.finish_templates[key] = template
+
+
+class TemplateRecorder:
+    """
+    Stands in for GlobalState while generating a FinishTemplate. Names and late
+    rodata constants are replaced by placeholders, and the order in which they
+    were asked for is recorded, to be filled in later from the real state.
+    """
+
+    def __init__(self, state):
+        self.min_instr_count = state.min_instr_count
+        self.skip_instr_count = state.skip_instr_count
+        self.use_jtbl_for_rodata = state.use_jtbl_for_rodata
+        self.max_fn_size = state.max_fn_size
+        self.jtbl_instr_count = state.jtbl_instr_count
+        self.slots = []
 
-Function = namedtuple('Function', ['text_glabels', 'asm_conts', 'late_rodata_dummy_bytes', 'jtbl_rodata_size', 'late_rodata_asm_conts', 'fn_desc', 'data'])
+    def placeholder(self, slot):
+        self.slots.append(slot)
+        return '\0{}\0'.format(len(self.slots) - 1)
+
+    def make_late_rodata_float(self):
+        return [], self.placeholder('float')
+
+    def make_late_rodata_double(self):
+        return [], self.placeholder('double')
+
+    def make_name(self, cat):
+        return self.placeholder(cat)
+
+
+class FinishTemplate:
+    """
+    The C code and function data that GlobalAsmBlock.finish generates for
+    blocks of a given shape, with placeholders for names and late rodata
+    constants. Many blocks (e.g. small stubs) share a shape, and stamping out
+    a template is much cheaper than generating the C again.
+    """
+
+    def __init__(self, src, fn, slots):
+        self.src = src
+        # Lines with placeholders, as format strings taking the slot values.
+        self.marked_lines = [(i, FinishTemplate.to_format(line)) for i, line in enumerate(src) if '\0' in line]
+        self.jtbl_rodata_size = fn.jtbl_rodata_size
+        self.data = {sectype: (None if name is None else FinishTemplate.to_format(name), size)
+                for sectype, (name, size) in fn.data.items()}
+        self.slots = slots
+
+    @staticmethod
+    def to_format(text):
+        parts = text.replace('{', '{{').replace('}', '}}').split('\0')
+        parts[1::2] = ['{' + ind + '}' for ind in parts[1::2]]
+        return ''.join(parts)
+
+    def stamp(self, block, state):
+        values = []
+        late_rodata_dummy_bytes = []
+        for slot in self.slots:
+            if slot == 'float':
+                dummy_bytes, value = state.make_late_rodata_float()
+                late_rodata_dummy_bytes.extend(dummy_bytes)
+            elif slot == 'double':
+                dummy_bytes, value = state.make_late_rodata_double()
+                late_rodata_dummy_bytes.extend(dummy_bytes)
+            else:
+                value = state.make_name(slot)
+            values.append(value)
+
+        src = list(self.src)
+        for i, fmt in self.marked_lines:
+            src[i] = fmt.format(*values)
+        fn = Function(
+                text_glabels=block.text_glabels,
+                asm_conts=block.asm_conts,
+                late_rodata_dummy_bytes=late_rodata_dummy_bytes,
+                jtbl_rodata_size=self.jtbl_rodata_size,
+                late_rodata_asm_conts=block.late_rodata_asm_conts,
+                fn_desc=block.fn_desc,
+                incbins=block.incbins,
+                split_points=block.split_points,
+                data={sectype: (None if fmt is None else fmt.format(*values), size)
+                    for sectype, (fmt, size) in self.data.items()})
+        return src, fn
+
+
+class AsmFile:
+    """
+    A GLOBAL_ASM("file.s") source. Such files can be huge, so rather than
+    keeping their lines in memory, blocks refer to them by AsmFileRange, and
+    they are read again when writing the assembler input.
+    """
+    def __init__(self, path, input_enc):
+        self.path = path
+        self.input_enc = input_enc
+        self.stamp = self.get_stamp(os.stat(path))
+        # Byte offsets only make sense if each line ends in a '\n' byte.
+        self.seekable = ('\n'.encode(input_enc) == b'\n')
+
+    @staticmethod
+    def get_stamp(st):
+        return (st.st_mtime_ns, st.st_size)
+
+    def open(self):
+        f = open(self.path, 'rb')
+        if self.get_stamp(os.fstat(f.fileno())) != self.stamp:
+            f.close()
+            raise Failure("{} was modified during the build".format(self.path))
+        return f
+
+    def read(self):
+        # Yields (line, source) pairs, where source is (self, start, end) for
+        # the bytes of just that line, or None if it can't be read back on its
+        # own. Lines are split like in text mode, i.e. also on '\r'.
+        if not self.seekable:
+            with open(self.path, encoding=self.input_enc) as f:
+                for line in f:
+                    yield line.rstrip(), None
+            return
+        with self.open() as f:
+            pos = 0
+            for raw_line in f:
+                end = pos + len(raw_line)
+                line = raw_line.decode(self.input_enc)
+                if '\r' not in line.rstrip('\n')[:-1]:
+                    yield line.rstrip(), (self, pos, end)
+                else:
+                    lines = line.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+                    if lines[-1] == '':
+                        lines.pop()
+                    for line in lines:
+                        yield line.rstrip(), None
+                pos = end
+
+class AsmFileRange:
+    def __init__(self, asm_file, start, end):
+        self.asm_file = asm_file
+        self.start = start
+        self.end = end
+
+    def lines(self, f):
+        f.seek(self.start)
+        pos = self.start
+        while pos < self.end:
+            raw_line = f.readline()
+            pos += len(raw_line)
+            yield raw_line.decode(self.asm_file.input_enc).rstrip()
+
+def iter_asm_lines(conts):
+    # Expand a list of asm lines and AsmFileRanges into lines.
+    files = {}
+    try:
+        for line in conts:
+            if isinstance(line, str):
+                yield line
+                continue
+            f = files.get(line.asm_file)
+            if f is None:
+                f = files[line.asm_file] = line.asm_file.open()
+            yield from line.lines(f)
+    finally:
+        for f in files.values():
+            f.close()
+
+def hash_asm_lines(h, conts, enc, include_lines=None):
+    # Add asm lines and AsmFileRanges to a hash, without first reading all of
+    # them into memory. Lines that may refer to other files are appended to
+    # include_lines, if given.
+    for line in iter_asm_lines(conts):
+        h.update(line.encode(enc) + b'\n')
+        if include_lines is not None and ('.include' in line or '.incbin' in line):
+            include_lines.append(line)
+    h.update(b'\0')
+
+
+class Function:
+    def __init__(self, text_glabels, asm_conts, late_rodata_dummy_bytes, jtbl_rodata_size, late_rodata_asm_conts, fn_desc, data, incbins=(), split_points=()):
+        self.text_glabels = text_glabels
+        self.asm_conts = asm_conts
+        self.incbins = incbins
+        self.split_points = split_points
+        self.late_rodata_dummy_bytes = late_rodata_dummy_bytes
+        self.jtbl_rodata_size = jtbl_rodata_size
+        self.late_rodata_asm_conts = late_rodata_asm_conts
+        self.fn_desc = fn_desc
+        self.data = data
+
+    def replace(self, **changes):
+        fn = Function(**self.__dict__)
+        fn.__dict__.update(changes)
+        return fn
 
 
 class GlobalAsmBlock:
-    def __init__(self, fn_desc):
+    def __init__(self, fn_desc, size_probe=None, shardable=False):
         self.fn_desc = fn_desc
+        self.size_probe = size_probe
+        self.shardable = shardable
+        self.regexes = compiled_regexes()
         self.cur_section = '.text'
         self.asm_conts = []
         self.late_rodata_asm_conts = []
         self.late_rodata_alignment = 0
         self.late_rodata_alignment_from_content = False
         self.text_glabels = []
+        self.incbins = []
         self.fn_section_sizes = {
             '.text': 0,
             '.data': 0,
@@ -413,7 +735,10 @@ class GlobalAsmBlock:
             '.rodata': 0,
             '.late_rodata': 0,
         }
+        # Runs of (first line, number of lines, instructions per line), since
+        # blocks from GLOBAL_ASM("file.s") can have millions of lines.
         self.fn_ins_inds = []
+        self.split_points = []
         self.glued_line = ''
         self.num_lines = 0
 
@@ -484,24 +809,76 @@ class GlobalAsmBlock:
         if self.cur_section == '.text':
             if not self.text_glabels:
                 self.fail(".text block without an initial glabel", line)
-            self.fn_ins_inds.append((self.num_lines - 1, size // 4))
+            line, count = self.num_lines - 1, size // 4
+            if self.fn_ins_inds:
+                first, length, prev_count = self.fn_ins_inds[-1]
+                if prev_count == count and first + length == line:
+                    self.fn_ins_inds[-1] = (first, length + 1, count)
+                    return
+            self.fn_ins_inds.append((line, 1, count))
+
+    def instruction_lines(self):
+        # The line of each instruction, in order.
+        for first, length, count in self.fn_ins_inds:
+            for line in range(first, first + length):
+                for _ in range(count):
+                    yield line
+
+    def add_split_point(self, min_size):
+        # Remember where the assembly could be cut for --assemble-shards, if
+        # we're min_size bytes of .text past the previous such point. The
+        # sizes of the other sections rarely change between points, so their
+        # tuple is shared with the previous point when they don't.
+        text_size = self.fn_section_sizes['.text']
+        prev = self.split_points[-1] if self.split_points else None
+        if not self.shardable or text_size < (prev[4] if prev else 0) + min_size:
+            return
+        other_sizes = tuple(self.fn_section_sizes[sectype] for sectype in SPLIT_POINT_SECTIONS)
+        if prev and prev[5] == other_sizes:
+            other_sizes = prev[5]
+        def position(conts):
+            last = conts[-1] if conts else None
+            return len(conts), (last.end if isinstance(last, AsmFileRange) else None)
+        self.split_points.append(position(self.asm_conts) + position(self.late_rodata_asm_conts) + (text_size, other_sizes))
+
+    def add_asm_line(self, conts, line, source):
+        if source is None:
+            conts.append(line)
+            return
+        asm_file, start, end = source
+        last = conts[-1] if conts else None
+        if isinstance(last, AsmFileRange) and last.asm_file is asm_file and last.end == start:
+            last.end = end
+        else:
+            conts.append(AsmFileRange(asm_file, start, end))
 
-    def process_line(self, line, output_enc):
+    def process_line(self, line, output_enc, source=None):
+        # source is (asm_file, start, end) for the bytes of the line in a
+        # GLOBAL_ASM("file.s") source, if any (see AsmFile.read).
         self.num_lines += 1
         if line.endswith('\\'):
             self.glued_line += line[:-1]
             return
+        if self.glued_line:
+            source = None
         line = self.glued_line + line
         self.glued_line = ''
 
         real_line = line
-        line = re.sub(re_comment_or_string, re_comment_replacer, line)
+        asm_line = real_line
+        line = self.regexes.comment_or_string.sub(re_comment_replacer, line)
         line = line.strip()
-        line = re.sub(r'^[a-zA-Z0-9_]+:\s*', '', line)
+        label_line = line
+        line = self.regexes.label_prefix.sub('', line, count=1)
         changed_section = False
         emitting_double = False
         if line.startswith('glabel ') and self.cur_section == '.text':
             self.text_glabels.append(line.split()[1])
+            # Cut between functions where possible, since labels within a
+            # function can't be referenced from another shard.
+            self.add_split_point(ASSEMBLE_SPLIT_SIZE)
+        elif self.cur_section == '.text':
+            self.add_split_point(8 * ASSEMBLE_SPLIT_SIZE)
         if not line:
             pass # empty line
         elif line.startswith('glabel ') or (' ' not in line and line.endswith(':')):
@@ -523,7 +900,15 @@ class GlobalAsmBlock:
             self.late_rodata_alignment = value
             changed_section = True
         elif line.startswith('.incbin'):
-            self.add_sized(int(line.split(',')[-1].strip(), 0), real_line)
+            size = int(line.split(',')[-1].strip(), 0)
+            incbin = self.parse_incbin(real_line)
+            if incbin is not None:
+                # Splice the file contents in ourselves when post-processing,
+                # so the assembler only has to emit padding.
+                path, skip = incbin
+                self.incbins.append((self.cur_section, self.fn_section_sizes[self.cur_section], path, skip, size))
+                asm_line = label_line[:len(label_line) - len(line)] + '.space {}'.format(size)
+            self.add_sized(size, real_line)
         elif line.startswith('.word') or line.startswith('.float'):
             self.align4()
             self.add_sized(4 * len(line.split(',')), real_line)
@@ -562,6 +947,13 @@ class GlobalAsmBlock:
         elif line.startswith('.'):
             # .macro, ...
             self.fail("asm directive not supported", real_line)
+        elif self.size_probe is not None and (self.cur_section != '.text' or needs_size_probe(line)):
+            # Macro call or pseudo-instruction, sized by assembling it.
+            size = self.size_probe.lookup(self.cur_section, line)
+            if size is None:
+                self.fail("failed to assemble line on its own to determine its size", real_line)
+            if size:
+                self.add_sized(size, real_line)
         else:
             # Unfortunately, macros are hard to support for .rodata --
             # we don't know how how space they will expand to before
@@ -571,6 +963,7 @@ class GlobalAsmBlock:
             # cases), or change how this program is invoked.
             # Similarly, we can't currently deal with pseudo-instructions
             # that expand to several real instructions.
+            # (--probe-sizes does the former, see SizeProbe.)
             if self.cur_section != '.text':
                 self.fail("instruction or macro call in non-.text section? not supported", real_line)
             self.add_sized(4, real_line)
@@ -578,13 +971,37 @@ class GlobalAsmBlock:
             if not changed_section:
                 if emitting_double:
                     self.late_rodata_asm_conts.append(".align 0")
-                self.late_rodata_asm_conts.append(real_line)
+                self.add_asm_line(self.late_rodata_asm_conts, real_line, source)
                 if emitting_double:
                     self.late_rodata_asm_conts.append(".align 2")
         else:
-            self.asm_conts.append(real_line)
+            self.add_asm_line(self.asm_conts, asm_line, source if asm_line is real_line else None)
+
+    def parse_incbin(self, real_line):
+        # Returns (path, skip) for '.incbin "path", skip, size' lines whose
+        # contents we can copy directly, or None to leave them to the assembler.
+        m = self.regexes.incbin.match(real_line)
+        if not m or self.cur_section not in ['.text', '.data', '.rodata']:
+            return None
+        path = m.group(1)
+        if not os.path.isfile(path):
+            # Probably relative to an assembler include directory.
+            return None
+        return path, int(m.group(2).strip(), 0)
 
     def finish(self, state):
+        # The generated C only depends on the block's shape, up to names and
+        # late rodata constants, so reuse it between blocks of the same shape.
+        key = (self.num_lines, tuple(self.fn_ins_inds), tuple(self.fn_section_sizes.values()), self.late_rodata_alignment)
+        template = state.finish_templates.pop(key, None)
+        if template is None:
+            recorder = TemplateRecorder(state)
+            src, fn = self.generate(recorder)
+            template = FinishTemplate(src, fn, recorder.slots)
+        state.add_finish_template(key, template)
+        return template.stamp(self, state)
+
+    def generate(self, state):
         src = [''] * (self.num_lines + 1)
         late_rodata_dummy_bytes = []
         jtbl_rodata_size = 0
@@ -604,36 +1021,37 @@ class GlobalAsmBlock:
                 if skip_next:
                     skip_next = False
                     continue
-                # Jump tables give 9 instructions for >= 5 words of rodata, and should be
-                # emitted when:
-                # - -O2 or -O2 -g3 are used, which give the right codegen
+                # Jump tables give 9 instructions (jtbl_instr_count) for >= 5 words of
+                # rodata, and should be emitted when:
+                # - -O2 or -O2 -g3 are used, which give the right codegen (or the
+                #   instruction count has been determined for other flags, see
+                #   find-jtbl-instr-count.sh)
                 # - we have emitted our first .float/.double (to ensure that we find the
                 #   created rodata in the binary)
                 # - we have emitted our first .double, if any (to ensure alignment of doubles
                 #   in shifted rodata sections)
                 # - we have at least 5 words of rodata left to emit (otherwise IDO does not
                 #   generate a jump table)
-                # - we have at least 10 more instructions to go in this function (otherwise our
-                #   function size computation will be wrong since the delay slot goes unused)
+                # - we have at least jtbl_instr_count + 1 more instructions to go in this
+                #   function (otherwise our function size computation will be wrong since
+                #   the delay slot goes unused)
                 if (not needs_double and state.use_jtbl_for_rodata and i >= 1 and
-                        size - i >= 5 and num_instr - len(late_rodata_fn_output) >= 10):
+                        size - i >= 5 and num_instr - len(late_rodata_fn_output) >= state.jtbl_instr_count + 1):
                     cases = " ".join("case {}:".format(case) for case in range(size - i))
                     late_rodata_fn_output.append("switch (*(volatile int*)0) { " + cases + " ; }")
-                    late_rodata_fn_output.extend([""] * 8)
+                    late_rodata_fn_output.extend([""] * (state.jtbl_instr_count - 1))
                     jtbl_rodata_size = (size - i) * 4
                     break
-                dummy_bytes = state.next_late_rodata_hex()
-                late_rodata_dummy_bytes.append(dummy_bytes)
                 if self.late_rodata_alignment == 4 * ((i + 1) % 2 + 1) and i + 1 < size:
-                    dummy_bytes2 = state.next_late_rodata_hex()
-                    late_rodata_dummy_bytes.append(dummy_bytes2)
-                    fval, = struct.unpack('>d', dummy_bytes + dummy_bytes2)
+                    dummy_bytes, fval = state.make_late_rodata_double()
+                    late_rodata_dummy_bytes.extend(dummy_bytes)
                     late_rodata_fn_output.append('*(volatile double*)0 = {};'.format(fval))
                     skip_next = True
                     needs_double = True
                 else:
-                    fval, = struct.unpack('>f', dummy_bytes)
-                    late_rodata_fn_output.append('*(volatile float*)0 = {}f;'.format(fval))
+                    dummy_bytes, fval = state.make_late_rodata_float()
+                    late_rodata_dummy_bytes.extend(dummy_bytes)
+                    late_rodata_fn_output.append('*(volatile float*)0 = {};'.format(fval))
                 late_rodata_fn_output.append('')
                 late_rodata_fn_output.append('')
 
@@ -650,25 +1068,29 @@ class GlobalAsmBlock:
             fn_emitted = 0
             fn_skipped = 0
             rodata_stack = late_rodata_fn_output[::-1]
-            for (line, count) in self.fn_ins_inds:
-                for _ in range(count):
-                    if (fn_emitted > MAX_FN_SIZE and instr_count - tot_emitted > state.min_instr_count and
-                            (not rodata_stack or rodata_stack[-1])):
-                        # Don't let functions become too large. When a function reaches 284
-                        # instructions, and -O2 -framepointer flags are passed, the IRIX
-                        # compiler decides it is a great idea to start optimizing more.
-                        fn_emitted = 0
-                        fn_skipped = 0
-                        src[line] += ' }} void {}(void) {{ '.format(state.make_name('large_func'))
-                    if fn_skipped < state.skip_instr_count:
-                        fn_skipped += 1
-                        tot_skipped += 1
-                    elif rodata_stack:
-                        src[line] += rodata_stack.pop()
-                    else:
-                        src[line] += '*(volatile int*)0 = 0;'
-                    tot_emitted += 1
-                    fn_emitted += 1
+            # Set after a jump table dispatch, until the instruction that fills
+            # its delay slot has been emitted in the same function.
+            jtbl_delay_slot = False
+            for line in self.instruction_lines():
+                if (fn_emitted > state.max_fn_size and instr_count - tot_emitted > state.min_instr_count and
+                        (not rodata_stack or rodata_stack[-1]) and not jtbl_delay_slot):
+                    # Don't let functions become too large. When a function reaches 284
+                    # instructions, and -O2 -framepointer flags are passed, the IRIX
+                    # compiler decides it is a great idea to start optimizing more.
+                    fn_emitted = 0
+                    fn_skipped = 0
+                    src[line] += ' }} void {}(void) {{ '.format(state.make_name('large_func'))
+                if fn_skipped < state.skip_instr_count:
+                    fn_skipped += 1
+                    tot_skipped += 1
+                elif rodata_stack:
+                    src[line] += rodata_stack.pop()
+                    jtbl_delay_slot = (not rodata_stack and jtbl_rodata_size > 0)
+                else:
+                    src[line] += '*(volatile int*)0 = 0;'
+                    jtbl_delay_slot = False
+                tot_emitted += 1
+                fn_emitted += 1
             if rodata_stack:
                 size = len(late_rodata_fn_output) // 3
                 available = instr_count - tot_skipped
@@ -700,6 +1122,8 @@ class GlobalAsmBlock:
                 jtbl_rodata_size=jtbl_rodata_size,
                 late_rodata_asm_conts=self.late_rodata_asm_conts,
                 fn_desc=self.fn_desc,
+                incbins=self.incbins,
+                split_points=self.split_points,
                 data={
                     '.text': (text_name, self.fn_section_sizes['.text']),
                     '.data': (data_name, self.fn_section_sizes['.data']),
@@ -708,13 +1132,301 @@ class GlobalAsmBlock:
                 })
         return src, fn
 
-cutscene_data_regexpr = re.compile(r"CutsceneData (.|\n)*\[\] = {")
-float_regexpr = re.compile(r"[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?f")
+# Instructions that always assemble to a single instruction, so that they
+# don't need to be probed by SizeProbe. Loads and stores are only single
+# instructions when given a base register.
+SINGLE_INSTRUCTIONS = frozenset("""
+    add addi addiu addu and andi beq beql bgez bgezal bgezall bgezl bgtz bgtzl
+    blez blezl bltz bltzal bltzall bltzl bne bnel break cache dadd daddi daddiu
+    daddu ddiv ddivu div divu dmult dmultu dsll dsll32 dsllv dsra dsra32 dsrav
+    dsrl dsrl32 dsrlv dsub dsubu eret j jal jalr jr lui mfhi mflo mthi mtlo mult
+    multu nor or ori sll sllv slt slti sltiu sltu sra srav srl srlv sub subu sync
+    syscall teq teqi tge tgei tgeiu tgeu tlbp tlbr tlbwi tlbwr tlt tlti tltiu tltu
+    tne tnei xor xori mfc0 mtc0 dmfc0 dmtc0 mfc1 mtc1 dmfc1 dmtc1 cfc1 ctc1 mfc2
+    mtc2 cfc2 ctc2 bc1f bc1t bc1fl bc1tl nop move b bal beqz bnez beqzl bnezl neg
+    negu dneg dnegu not
+""".split() + [op + '.' + fmt for fmt in 'sd' for op in """
+    add sub mul div abs mov neg sqrt round.w trunc.w ceil.w floor.w round.l
+    trunc.l ceil.l floor.l c.f c.un c.eq c.ueq c.olt c.ult c.ole c.ule c.sf
+    c.ngle c.seq c.ngl c.lt c.nge c.le c.ngt
+""".split()] + ['cvt.' + a + '.' + b for a in 'sdwl' for b in 'sdwl' if a != b])
+LOAD_STORE_INSTRUCTIONS = frozenset("""
+    lb lbu lh lhu lw lwl lwr lwu ld ldl ldr ll lld sb sh sw swl swr sd sdl sdr sc
+    scd lwc1 swc1 ldc1 sdc1 lwc2 swc2
+""".split())
+
+def needs_size_probe(line):
+    # Whether an instruction line (without labels or comments) in .text may
+    # be a macro call or expand to several instructions.
+    parts = line.split(None, 1)
+    mnemonic = parts[0].lower()
+    operands = parts[1] if len(parts) > 1 else ''
+    if mnemonic in LOAD_STORE_INSTRUCTIONS:
+        return '(' not in operands
+    if mnemonic in ['div', 'divu', 'ddiv', 'ddivu']:
+        # The three-operand forms are macros.
+        return operands.count(',') == 2
+    return mnemonic not in SINGLE_INSTRUCTIONS
+
+class SizeProbe:
+    """
+    Determines the sizes of macro calls and pseudo-instructions, which
+    process_line can't compute on its own, by assembling them (with the
+    prelude, where macros are defined). Each distinct line is assembled just
+    once: results are remembered, in object_cache if given, keyed by the
+    assembler command and prelude.
+
+    Lines missing from the cache are collected by lookup while processing a
+    block, and are then assembled together by probe_missing, after which the
+    block is processed again (see process_block_lines). Sizes found this way
+    are also kept in `probed`, so that process_blocks_in_parallel can send
+    them back from its workers.
+    """
+
+    def __init__(self, assembler, asm_prelude=b'', output_enc='latin1', object_cache=None):
+        import hashlib
+        self.assembler = assembler
+        self.asm_prelude = asm_prelude
+        self.output_enc = output_enc
+        self.object_cache = object_cache
+        self.key = hashlib.sha256(b'probe\0' + assembler.encode('utf-8') + b'\0' + asm_prelude + b'\0' + output_enc.encode('utf-8')).hexdigest()
+        self.sizes = {}
+        self.missing = set()
+        self.probed = {}
+        self.load()
+
+    def load(self):
+        if self.object_cache is None:
+            return
+        data = self.object_cache.get(self.key, '.probe')
+        if data is None:
+            return
+        for entry in data.decode('utf-8').split('\n'):
+            if entry:
+                size, sectype, line = entry.split(' ', 2)
+                self.sizes[(sectype, line)] = int(size)
+
+    def save(self):
+        if self.object_cache is None:
+            return
+        # Merge with what other processes may have found in the meantime.
+        self.load()
+        entries = ['{} {} {}\n'.format(size, sectype, line)
+                for (sectype, line), size in sorted(self.sizes.items()) if size is not None]
+        self.object_cache.put(self.key, ''.join(entries).encode('utf-8'), '.probe')
+
+    def lookup(self, sectype, line):
+        # Returns the size of a line in the given section, None if it couldn't
+        # be determined, or a provisional size if it hasn't been probed yet.
+        key = (sectype, line)
+        if key not in self.sizes:
+            self.missing.add(key)
+            return 4 if sectype == '.text' else 0
+        return self.sizes[key]
+
+    def assemble(self, forms):
+        # Assemble each line in a section of its own, returning their sizes.
+        asm = []
+        for i, (sectype, line) in enumerate(forms):
+            sectype = '.rodata' if sectype == '.late_rodata' else sectype
+            asm.append('.section {}.asmppprobe{},{}'.format(sectype, i, BATCH_SECTION_FLAGS[sectype]))
+            asm.append('glabel _asmpp_probe{}_start'.format(i))
+            asm.append(line)
+            asm.append('glabel _asmpp_probe{}_end'.format(i))
+        asm_objfile = ElfFile(run_assembler(asm, self.asm_prelude, self.assembler, self.output_enc))
+        sizes = []
+        for i in range(len(forms)):
+            start = asm_objfile.symtab.find_symbol('_asmpp_probe{}_start'.format(i))
+            end = asm_objfile.symtab.find_symbol('_asmpp_probe{}_end'.format(i))
+            sizes.append(end[1] - start[1])
+        return sizes
+
+    def probe_missing(self):
+        forms = sorted(self.missing)
+        self.missing = set()
+        try:
+            sizes = self.assemble(forms)
+        except Failure:
+            # Find out which of the lines failed.
+            sizes = []
+            for form in forms:
+                try:
+                    sizes.extend(self.assemble([form]))
+                except Failure:
+                    sizes.append(None)
+        self.sizes.update(zip(forms, sizes))
+        self.probed.update(zip(forms, sizes))
+        self.save()
+
+    def merge(self, probed):
+        # Add sizes probed by another copy of this SizeProbe.
+        new = {form: size for form, size in probed.items() if form not in self.sizes}
+        if new:
+            self.sizes.update(new)
+            self.probed.update(new)
+            self.save()
+
+
+class BlockCache:
+    """
+    Remembers the results of processing GLOBAL_ASM blocks, so that --watch
+    mode only has to redo the blocks that changed between runs. A block is
+    reused if its contents and the GlobalState at its start are unchanged,
+    which keeps generated names and late rodata constants stable.
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.used_blocks = {}
+        self.deps = set()
+        self.hits = 0
+        self.misses = 0
+
+    def start_run(self):
+        self.used_blocks = {}
+        self.deps = set()
+        self.hits = 0
+        self.misses = 0
+
+    def end_run(self):
+        # Forget blocks that no longer exist, so memory use stays bounded.
+        self.blocks = self.used_blocks
+        self.used_blocks = {}
+
+
+def process_block_lines(fn_desc, lines, output_enc, size_probe=None, shardable=False):
+    global_asm = GlobalAsmBlock(fn_desc, size_probe, shardable)
+    try:
+        if isinstance(lines, AsmFile):
+            for line, source in lines.read():
+                global_asm.process_line(line, output_enc, source)
+        else:
+            for line in lines:
+                global_asm.process_line(line, output_enc)
+    except Failure:
+        # Possibly caused by provisional sizes.
+        if size_probe is None or not size_probe.missing:
+            raise
+    if size_probe is not None and size_probe.missing:
+        size_probe.probe_missing()
+        return process_block_lines(fn_desc, lines, output_enc, size_probe, shardable)
+    return global_asm
+
+def try_process_block_lines(args):
+    # Worker for process_blocks_in_parallel. Failures are returned rather than
+    # raised, so that they can be reported in source order. Also returns the
+    # sizes probed for the block, which the parent saves.
+    fn_desc, lines, output_enc, size_probe, shardable = args
+    if size_probe is not None:
+        size_probe.object_cache = None
+    try:
+        global_asm = process_block_lines(fn_desc, lines, output_enc, size_probe, shardable)
+    except Failure as e:
+        global_asm = e
+    if size_probe is None:
+        return global_asm, {}
+    if not isinstance(global_asm, Failure):
+        # Don't send the whole SizeProbe back.
+        global_asm.size_probe = None
+    return global_asm, size_probe.probed
+
+def process_blocks_in_parallel(blocks, output_enc, jobs, size_probe=None, shardable=False):
+    """
+    Run process_line for a list of (fn_desc, lines) blocks in a process pool.
+    This only depends on the block itself, unlike finish, which must run in
+    order since it consumes names and late rodata values from GlobalState.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    work = [(fn_desc, lines, output_enc, size_probe, shardable) for (fn_desc, lines) in blocks]
+    chunksize = max(1, len(work) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(try_process_block_lines, work, chunksize=chunksize))
+    blocks = []
+    for global_asm, probed in results:
+        if size_probe is not None:
+            size_probe.merge(probed)
+            if not isinstance(global_asm, Failure):
+                global_asm.size_probe = size_probe
+        blocks.append(global_asm)
+    return blocks
+
+def process_global_asm(fn_desc, lines, state, output_enc, cache=None, global_asm=None, size_probe=None, shardable=False):
+    key = None
+    if cache is not None:
+        # fn_desc is left out of the key, so that blocks which merely moved
+        # to another line can be reused as well.
+        contents = (lines.path, lines.stamp) if isinstance(lines, AsmFile) else tuple(lines)
+        key = (contents, output_enc, state.namectr,
+                state.late_rodata_hex, state.min_instr_count,
+                state.skip_instr_count, state.use_jtbl_for_rodata,
+                state.max_fn_size, state.jtbl_instr_count,
+                size_probe.key if size_probe is not None else None, shardable)
+        if key in cache.blocks:
+            src, fn, state.namectr, state.late_rodata_hex = cache.blocks[key]
+            cache.used_blocks[key] = cache.blocks[key]
+            cache.hits += 1
+            return src, fn.replace(fn_desc=fn_desc)
+        cache.misses += 1
+    if global_asm is None:
+        global_asm = process_block_lines(fn_desc, lines, output_enc, size_probe, shardable)
+    elif isinstance(global_asm, Failure):
+        raise global_asm
+    src, fn = global_asm.finish(state)
+    if cache is not None:
+        cache.used_blocks[key] = (src, fn, state.namectr, state.late_rodata_hex)
+    return src, fn
+
+cutscene_data_regexpr = r"CutsceneData (.|\n)*\[\] = {"
+float_regexpr = r"[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?f"
 
 def repl_float_hex(m):
     return str(struct.unpack(">I", struct.pack(">f", float(m.group(0).strip().rstrip("f"))))[0])
 
-def parse_source(f, opt, framepointer, input_enc, output_enc, print_source=None):
+# Source files that contain none of these are passed through unchanged.
+SOURCE_TRIGGERS = [b'GLOBAL_ASM', b'EARLY', b'CutsceneData']
+# ASCII characters that str.rstrip removes from the end of a line.
+TRAILING_WHITESPACE = [b' ', b'\t', b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e', b'\x1f']
+
+def is_plain_source(data, input_enc):
+    """
+    Quickly check, on raw bytes, whether a source file has nothing for
+    parse_source to do, i.e. no GLOBAL_ASM blocks, EARLY includes or
+    CutsceneData arrays, and no line endings or trailing whitespace for it to
+    normalize. May return false negatives, never false positives.
+    """
+    for token in SOURCE_TRIGGERS:
+        if token.decode('ascii').encode(input_enc) != token:
+            # Encoding isn't ASCII-compatible, so we can't scan the raw bytes.
+            return False
+        if data.find(token) != -1:
+            return False
+    if data.find(b'\r') != -1 or data[-1:] in TRAILING_WHITESPACE:
+        return False
+    for ws in TRAILING_WHITESPACE:
+        if data.find(ws + b'\n') != -1:
+            return False
+    # Non-ASCII characters may be whitespace too, depending on the encoding.
+    return bytes(data).isascii()
+
+class ReadSource(bytes):
+    # map_source result for files that can't be mapped, usable in a with
+    # statement like an mmap.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+def map_source(f):
+    # Map a file opened in binary mode into memory, falling back to reading
+    # it for empty files and pipes, which can't be mapped. The result should
+    # be used in a with statement, to unmap the file again.
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return ReadSource(f.read())
+
+def make_global_state(opt, framepointer, max_fn_size=MAX_FN_SIZE, jtbl_instr_count=None):
     if opt in ['O2', 'O1']:
         if framepointer:
             min_instr_count = 6
@@ -740,14 +1452,75 @@ def parse_source(f, opt, framepointer, input_enc, output_enc, print_source=None)
             skip_instr_count = 2
 
     use_jtbl_for_rodata = False
-    if opt in ['O2', 'g3'] and not framepointer:
+    if (opt, framepointer) in JTBL_INSTR_COUNTS:
         use_jtbl_for_rodata = True
+    if jtbl_instr_count is not None:
+        # Explicitly given, see check_jtbl_instr_count.
+        use_jtbl_for_rodata = True
+    else:
+        jtbl_instr_count = JTBL_INSTR_COUNTS.get((opt, framepointer), JTBL_INSTR_COUNT)
 
-    state = GlobalState(min_instr_count, skip_instr_count, use_jtbl_for_rodata)
+    return GlobalState(min_instr_count, skip_instr_count, use_jtbl_for_rodata, max_fn_size, jtbl_instr_count)
+
+def check_jtbl_instr_count(opt, framepointer, jtbl_instr_count):
+    # Jump tables with the wrong instruction count silently give objects that
+    # don't match, so only allow counts that have been checked.
+    if jtbl_instr_count is not None and JTBL_INSTR_COUNTS.get((opt, framepointer)) != jtbl_instr_count:
+        raise Failure("--jtbl-instr-count {} has not been validated for these flags; see find-jtbl-instr-count.sh".format(jtbl_instr_count))
+
+def parse_source(f, opt, framepointer, input_enc, output_enc, print_source=None, cache=None, max_fn_size=MAX_FN_SIZE, jtbl_instr_count=None, jobs=1, size_probe=None, shardable=False):
+    variant = (opt, framepointer, max_fn_size, jtbl_instr_count)
+    functions = parse_source_variants(f, [variant], input_enc, output_enc, [print_source], cache, jobs, size_probe, shardable)[0]
+    if print_source and print_source != sys.stdout.buffer:
+        print_source.close()
+    return functions
+
+def parse_source_variants(f, variants, input_enc, output_enc, print_sources=None, cache=None, jobs=1, size_probe=None, shardable=False):
+    """
+    Like parse_source, but for several (opt, framepointer, max_fn_size,
+    jtbl_instr_count) variants at once. Only GlobalAsmBlock.finish depends on
+    the variant, so the source is read and its GLOBAL_ASM blocks are parsed
+    just once. The C code for each variant is written to the matching element
+    of print_sources, and a list of functions is returned for each variant.
+    Unlike parse_source, this leaves print_sources open.
+
+    If shardable, the functions also record where their assembly may be cut,
+    for post-processing them with --assemble-shards.
+    """
+    states = [make_global_state(*variant) for variant in variants]
+    if print_sources is None:
+        print_sources = [None] * len(variants)
+
+    regexes = compiled_regexes()
 
     global_asm = None
-    asm_functions = []
     output_lines = []
+    # Output of EARLY includes, which differs between variants, as
+    # (index, [output for each variant]).
+    include_outputs = []
+    # Output of GLOBAL_ASM blocks, as (index, is_file, [(src, fn) for each
+    # variant]), where index is the first output line of the block.
+    block_outputs = []
+    # With jobs > 1, GLOBAL_ASM blocks are processed after reading the whole
+    # file, so that this can be done in parallel. Elements are (fn_desc,
+    # lines, index, is_file). Otherwise, each block is processed as soon as it
+    # has been read, so that errors are reported in source order.
+    parallel = jobs > 1 and cache is None
+    pending_blocks = []
+
+    def process_block(fn_desc, lines, index, is_file, global_asm=None):
+        if global_asm is None and len(states) > 1:
+            global_asm = process_block_lines(fn_desc, lines, output_enc, size_probe, shardable)
+        outputs = [process_global_asm(fn_desc, lines, state, output_enc, cache, global_asm, size_probe, shardable) for state in states]
+        if cache is not None:
+            cache.deps.update(path for (_, _, path, _, _) in outputs[0][1].incbins)
+        block_outputs.append((index, is_file, outputs))
+
+    def add_block(fn_desc, lines, index, is_file):
+        if parallel:
+            pending_blocks.append((fn_desc, lines, index, is_file))
+        else:
+            process_block(fn_desc, lines, index, is_file)
 
     is_cutscene_data = False
 
@@ -762,68 +1535,306 @@ def parse_source(f, opt, framepointer, input_enc, output_enc, print_source=None)
 
         if global_asm is not None:
             if line.startswith(')'):
-                src, fn = global_asm.finish(state)
-                for i, line2 in enumerate(src):
-                    output_lines[start_index + i] = line2
-                asm_functions.append(fn)
+                add_block(global_asm_desc, global_asm, start_index, False)
                 global_asm = None
             else:
-                global_asm.process_line(raw_line, output_enc)
+                global_asm.append(raw_line)
         else:
             if line in ['GLOBAL_ASM(', '#pragma GLOBAL_ASM(']:
-                global_asm = GlobalAsmBlock("GLOBAL_ASM block at line " + str(line_no))
+                global_asm = []
+                global_asm_desc = "GLOBAL_ASM block at line " + str(line_no)
                 start_index = len(output_lines)
             elif ((line.startswith('GLOBAL_ASM("') or line.startswith('#pragma GLOBAL_ASM("'))
                     and line.endswith('")')):
                 fname = line[line.index('(') + 2 : -2]
-                global_asm = GlobalAsmBlock(fname)
-                with open(fname, encoding=input_enc) as f:
-                    for line2 in f:
-                        global_asm.process_line(line2.rstrip(), output_enc)
-                src, fn = global_asm.finish(state)
-                output_lines[-1] = ''.join(src)
-                asm_functions.append(fn)
-                global_asm = None
+                if cache is not None:
+                    cache.deps.add(fname)
+                add_block(fname, AsmFile(fname, input_enc), len(output_lines) - 1, True)
             elif ((line.startswith('#include "')) and line.endswith('" EARLY')):
                 # C includes qualified with EARLY (i.e. #include "file.c" EARLY) will be
                 # processed recursively when encountered
                 fpath = os.path.dirname(f.name)
                 fname = line[line.index(' ') + 2 : -7]
-                include_src = StringIO()
-                with open(fpath + os.path.sep + fname, encoding=input_enc) as include_file:
-                    parse_source(include_file, opt, framepointer, input_enc, output_enc, include_src)
-                output_lines[-1] = include_src.getvalue()
-                include_src.write('#line ' + str(line_no) + '\n')
-                include_src.close()
+                include_srcs = [StringIO() for _ in variants]
+                if cache is not None:
+                    cache.deps.add(os.path.join(fpath, fname))
+                with open(os.path.join(fpath, fname), encoding=input_enc) as include_file:
+                    parse_source_variants(include_file, variants, input_enc, output_enc, include_srcs, cache, jobs, size_probe, shardable)
+                include_outputs.append((len(output_lines) - 1, [include_src.getvalue() for include_src in include_srcs]))
+                for include_src in include_srcs:
+                    include_src.write('#line ' + str(line_no) + '\n')
+                    include_src.close()
             else:
                 # This is a hack to replace all floating-point numbers in an array of a particular type
                 # (in this case CutsceneData) with their corresponding IEEE-754 hexadecimal representation
-                if cutscene_data_regexpr.search(line) is not None:
+                if regexes.cutscene_data.search(line) is not None:
                     is_cutscene_data = True
                 elif line.endswith("};"):
                     is_cutscene_data = False
                 if is_cutscene_data:
-                    raw_line = re.sub(float_regexpr, repl_float_hex, raw_line)
+                    raw_line = regexes.float.sub(repl_float_hex, raw_line)
                 output_lines[-1] = raw_line
 
-    if print_source:
+    processed_blocks = [None] * len(pending_blocks)
+    if len(pending_blocks) > 1:
+        processed_blocks = process_blocks_in_parallel(
+                [(fn_desc, lines) for (fn_desc, lines, _, _) in pending_blocks], output_enc, jobs, size_probe, shardable)
+    for (fn_desc, lines, index, is_file), global_asm in zip(pending_blocks, processed_blocks):
+        process_block(fn_desc, lines, index, is_file, global_asm)
+
+    all_output_lines = [output_lines] + [list(output_lines) for _ in states[1:]]
+    for index, include_output in include_outputs:
+        for variant_lines, output in zip(all_output_lines, include_output):
+            variant_lines[index] = output
+    all_asm_functions = [[] for _ in states]
+    for index, is_file, outputs in block_outputs:
+        for (src, fn), variant_lines, asm_functions in zip(outputs, all_output_lines, all_asm_functions):
+            if is_file:
+                variant_lines[index] = ''.join(src)
+            else:
+                for i, line2 in enumerate(src):
+                    variant_lines[index + i] = line2
+            asm_functions.append(fn)
+
+    for print_source, variant_lines in zip(print_sources, all_output_lines):
+        if not print_source:
+            continue
         if isinstance(print_source, StringIO):
-            for line in output_lines:
+            for line in variant_lines:
                 print_source.write(line + '\n')
         else:
-            for line in output_lines:
+            for line in variant_lines:
                 print_source.write(line.encode(output_enc) + b'\n')
             print_source.flush()
-            if print_source != sys.stdout.buffer:
-                print_source.close()
 
-    return asm_functions
-
-def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc):
-    SECTIONS = ['.data', '.text', '.rodata', '.bss']
+    return all_asm_functions
 
+def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc, reproducible=False, assemble_shards=1, assemble_shard_size=None):
     with open(objfile_name, 'rb') as f:
-        objfile = ElfFile(f.read())
+        objfile_data = f.read()
+    if functions:
+        objfile_data = fixup_objfile_data(objfile_data, functions, asm_prelude, assembler, output_enc, assemble_shards, assemble_shard_size)
+    if reproducible:
+        objfile_data = make_reproducible(objfile_data)
+    with open(objfile_name, 'wb') as f:
+        f.write(objfile_data)
+
+def write_symbols(objfile, new_syms, num_local_syms):
+    # Rebuild strtab with just the names of the given symbols. (The strtab
+    # might double as shstrtab, in which case we keep section names.)
+    strtab = objfile.symtab.strtab
+    is_shstrtab = (strtab.index == objfile.elf_header.e_shstrndx)
+    builder = StrtabBuilder()
+    for s in new_syms:
+        builder.add(s.name)
+    if is_shstrtab:
+        for sec in objfile.sections:
+            builder.add(sec.name)
+    strtab.data, str_offsets = builder.build()
+    for s in new_syms:
+        s.st_name = str_offsets[s.name]
+    if is_shstrtab:
+        for sec in objfile.sections:
+            sec.sh_name = str_offsets[sec.name]
+    objfile.symtab.data = b''.join(s.to_bin() for s in new_syms)
+    objfile.symtab.sh_info = num_local_syms
+
+def reproducible_symbol_key(s):
+    return (s.type != STT_FILE, s.type != STT_SECTION, s.st_shndx, s.st_value, s.name, s.bind, s.type)
+
+def code_register_masks(data):
+    """
+    Compute the masks of general-purpose and floating-point registers used by
+    MIPS code, as GNU as records them in .reginfo (ri_gprmask and
+    ri_cprmask[1]): $zero is left out, and instructions on doubles also use
+    the odd register of each pair.
+    """
+    gprs = 0
+    fprs = 0
+    for (insn,) in struct.iter_unpack('>I', data[:len(data) & ~3]):
+        op = insn >> 26
+        rs = (insn >> 21) & 31
+        rt = (insn >> 16) & 31
+        rd = (insn >> 11) & 31
+        funct = insn & 63
+        if op == 0:
+            if funct in [0, 2, 3, 0x38, 0x3a, 0x3b, 0x3c, 0x3e, 0x3f]:
+                # shifts by a constant
+                gprs |= (1 << rt) | (1 << rd)
+            elif funct == 8 or funct == 0x11 or funct == 0x13:
+                # jr, mthi, mtlo
+                gprs |= 1 << rs
+            elif funct == 9:
+                # jalr
+                gprs |= (1 << rs) | (1 << rd)
+            elif funct == 0x10 or funct == 0x12:
+                # mfhi, mflo
+                gprs |= 1 << rd
+            elif 0x18 <= funct <= 0x1f or 0x30 <= funct <= 0x36:
+                # multiplications, divisions, traps
+                gprs |= (1 << rs) | (1 << rt)
+            elif funct not in [0xc, 0xd, 0xf]:
+                # not syscall, break or sync
+                gprs |= (1 << rs) | (1 << rt) | (1 << rd)
+        elif op == 1:
+            gprs |= 1 << rs
+            if 0x10 <= rt <= 0x13:
+                # bltzal, bgezal and their likely variants
+                gprs |= 1 << 31
+        elif op == 3:
+            # jal
+            gprs |= 1 << 31
+        elif op in [6, 7, 0x16, 0x17, 0x2f]:
+            # blez, bgtz and their likely variants, cache
+            gprs |= 1 << rs
+        elif op == 0xf:
+            # lui
+            gprs |= 1 << rt
+        elif op == 0x10:
+            if rs in [0, 1, 4, 5]:
+                # (d)mfc0, (d)mtc0
+                gprs |= 1 << rt
+        elif op == 0x11:
+            fs = rd
+            fd = (insn >> 6) & 31
+            if rs in [0, 1, 4, 5]:
+                # (d)mfc1, (d)mtc1
+                gprs |= 1 << rt
+                mask = 1 << fs
+                is_double = rs in [1, 5]
+            elif rs in [2, 6]:
+                # cfc1, ctc1
+                gprs |= 1 << rt
+                continue
+            elif rs in [16, 17, 20, 21]:
+                if funct <= 3:
+                    mask = (1 << fd) | (1 << fs) | (1 << rt)
+                elif funct >= 0x30:
+                    mask = (1 << fs) | (1 << rt)
+                else:
+                    mask = (1 << fd) | (1 << fs)
+                # Formats D and L, conversions to them, and .l roundings.
+                is_double = rs in [17, 21] or funct in [8, 9, 10, 11, 0x21, 0x25]
+            else:
+                continue
+            if is_double:
+                mask |= mask << 1
+            fprs |= mask
+        elif op in [0x31, 0x39]:
+            # lwc1, swc1
+            gprs |= 1 << rs
+            fprs |= 1 << rt
+        elif op in [0x35, 0x3d]:
+            # ldc1, sdc1
+            gprs |= 1 << rs
+            fprs |= 3 << rt
+        elif op in [0x32, 0x36, 0x3a, 0x3e]:
+            # loads and stores for coprocessor 2
+            gprs |= 1 << rs
+        elif op not in [2, 0x12, 0x13]:
+            # j and other coprocessors aside, the remaining instructions
+            # use rs and rt: branches, immediate arithmetic, loads, stores
+            gprs |= (1 << rs) | (1 << rt)
+    return gprs & ~1 & 0xffffffff, fprs & 0xffffffff
+
+def make_reproducible(objfile_data):
+    """
+    Normalize an object file, so that it doesn't depend on the paths it was
+    built from or the order symbols were merged in: file symbols are stripped
+    of directories, symbols are sorted, and debug info (which contains paths)
+    is dropped.
+    """
+    objfile = ElfFile(objfile_data)
+    objfile.drop_irrelevant_sections()
+    syms = objfile.symtab.symbol_entries
+    num_local_syms = objfile.symtab.sh_info
+    for s in syms:
+        if s.type == STT_FILE:
+            s.name = s.name.replace('\\', '/').split('/')[-1]
+    new_syms = (syms[:1] + sorted(syms[1:num_local_syms], key=reproducible_symbol_key) +
+            sorted(syms[num_local_syms:], key=reproducible_symbol_key))
+    for i, s in enumerate(new_syms):
+        s.new_index = i
+    write_symbols(objfile, new_syms, num_local_syms)
+    for sec in objfile.sections:
+        if sec.is_rel() and sec.sh_link == objfile.symtab.index:
+            for rel in sec.relocations:
+                rel.sym_index = syms[rel.sym_index].new_index
+            sec.data = relocations_to_bin(sec.relocations, sec.sh_type)
+    return objfile.to_bin()
+
+def copy_incbin(data, pos, path, skip, size, fn_desc):
+    if size == 0:
+        return
+    with open(path, 'rb') as f:
+        if skip + size > os.fstat(f.fileno()).st_size:
+            raise Failure(".incbin range out of bounds for file " + path + "\nwithin " + fn_desc)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                data[pos:pos + size] = view[skip:skip + size]
+
+
+FIXUP_SECTIONS = ['.data', '.text', '.rodata', '.bss']
+
+class Fixup:
+    """
+    The state of a post-processing in progress: the object file being fixed
+    up, the assembly to generate for it, and where the results should go.
+    """
+
+    def __init__(self, objfile, asm, to_copy, all_text_glabels, all_late_rodata_dummy_bytes, all_jtbl_rodata_size, late_rodata_source_name_start, late_rodata_source_name_end, functions=(), rodata_end=0):
+        self.objfile = objfile
+        self.asm = asm
+        self.to_copy = to_copy
+        self.all_text_glabels = all_text_glabels
+        self.all_late_rodata_dummy_bytes = all_late_rodata_dummy_bytes
+        self.all_jtbl_rodata_size = all_jtbl_rodata_size
+        self.late_rodata_source_name_start = late_rodata_source_name_start
+        self.late_rodata_source_name_end = late_rodata_source_name_end
+        # The functions in asm, as (function, {sectype: loc}), and where their
+        # late rodata starts (see shard_asm).
+        self.functions = functions
+        self.rodata_end = rodata_end
+
+def fixup_objfile_data(objfile_data, functions, asm_prelude, assembler, output_enc, assemble_shards=1, assemble_shard_size=None):
+    fixup = prepare_fixup(objfile_data, functions)
+    asm_objfile = assemble_fixup(fixup, asm_prelude, assembler, output_enc, assemble_shards, assemble_shard_size)
+    return merge_fixup(fixup, asm_objfile)
+
+def assemble_fixup(fixup, asm_prelude, assembler, output_enc, assemble_shards=1, assemble_shard_size=None):
+    if assemble_shards > 1:
+        pieces = fixup_pieces(fixup)
+        if assemble_shard_size is None:
+            assemble_shard_size = MIN_ASSEMBLE_SHARD_SIZE
+        bounds = shard_bounds(pieces, assemble_shards, assemble_shard_size)
+        if len(bounds) > 1:
+            try:
+                return assemble_sharded(fixup, pieces, bounds, asm_prelude, assembler, output_enc)
+            except Failure:
+                # Could be a limitation of sharding; if not, the error will
+                # show up again below. The shards' assembler output is
+                # discarded for the same reason.
+                pass
+    return ElfFile(run_assembler(fixup.asm, asm_prelude, assembler, output_enc))
+
+def function_asm(function, asm_conts, start_labels=True, end_labels=True):
+    # The assembly for (part of) a function, between labels marking where
+    # each of its sections starts and ends.
+    asm = []
+    for sectype, (temp_name, size) in function.data.items():
+        if temp_name is not None and start_labels:
+            asm.append('.section ' + sectype)
+            asm.append('glabel ' + temp_name + '_asm_start')
+    asm.append('.text')
+    asm.extend(asm_conts)
+    for sectype, (temp_name, size) in function.data.items():
+        if temp_name is not None and end_labels:
+            asm.append('.section ' + sectype)
+            asm.append('glabel ' + temp_name + '_asm_end')
+    return asm
+
+def prepare_fixup(objfile_data, functions):
+    objfile = ElfFile(objfile_data)
 
     prev_locs = {
         '.text': 0,
@@ -848,8 +1859,10 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc):
     # simplicity we pad with nops/.space so that addresses match exactly, so we
     # don't have to fix up relocations/symbol references.
     all_text_glabels = set()
+    included_functions = []
     for function in functions:
         ifdefed = False
+        locs = {}
         for sectype, (temp_name, size) in function.data.items():
             if temp_name is None:
                 continue
@@ -869,24 +1882,17 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc):
                         asm.append('nop')
                 else:
                     asm.append('.space {}'.format(loc - prev_loc))
-            to_copy[sectype].append((loc, size, temp_name, function.fn_desc))
+            incbins = [(offset, path, skip, count) for (sec, offset, path, skip, count) in function.incbins if sec == sectype]
+            to_copy[sectype].append((loc, size, temp_name, function.fn_desc, incbins))
             prev_locs[sectype] = loc + size
+            locs[sectype] = loc
         if not ifdefed:
+            included_functions.append((function, locs))
             all_text_glabels.update(function.text_glabels)
             all_late_rodata_dummy_bytes.append(function.late_rodata_dummy_bytes)
             all_jtbl_rodata_size.append(function.jtbl_rodata_size)
             late_rodata_asm.append(function.late_rodata_asm_conts)
-            for sectype, (temp_name, size) in function.data.items():
-                if temp_name is not None:
-                    asm.append('.section ' + sectype)
-                    asm.append('glabel ' + temp_name + '_asm_start')
-            asm.append('.text')
-            for line in function.asm_conts:
-                asm.append(line)
-            for sectype, (temp_name, size) in function.data.items():
-                if temp_name is not None:
-                    asm.append('.section ' + sectype)
-                    asm.append('glabel ' + temp_name + '_asm_end')
+            asm.extend(function_asm(function, function.asm_conts))
     if any(late_rodata_asm):
         late_rodata_source_name_start = '_asmpp_late_rodata_start'
         late_rodata_source_name_end = '_asmpp_late_rodata_end'
@@ -896,6 +1902,273 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc):
             asm.extend(conts)
         asm.append('glabel {}'.format(late_rodata_source_name_end))
 
+    return Fixup(objfile, asm, to_copy, all_text_glabels, all_late_rodata_dummy_bytes,
+            all_jtbl_rodata_size, late_rodata_source_name_start, late_rodata_source_name_end,
+            included_functions, prev_locs['.rodata'])
+
+def late_rodata_size(function):
+    # The size of a function's late rodata, as merge_fixup counts it.
+    return len(function.late_rodata_dummy_bytes) * 4 + function.jtbl_rodata_size
+
+def conts_between(conts, start, end):
+    # The part of a list of asm lines and AsmFileRanges between two positions
+    # (index, end) recorded by GlobalAsmBlock.add_split_point, where end, if
+    # not None, is where to cut the AsmFileRange conts[index - 1].
+    (i0, e0), (i1, e1) = start, end
+    piece = conts[i0:i1]
+    if e1 is not None and i1 > i0:
+        r = piece[-1]
+        piece[-1] = AsmFileRange(r.asm_file, r.start, e1)
+    if e0 is not None:
+        r = conts[i0 - 1]
+        piece.insert(0, AsmFileRange(r.asm_file, e0, e1 if e1 is not None and i1 == i0 else r.end))
+    return [line for line in piece if isinstance(line, str) or line.start < line.end]
+
+class FixupPiece:
+    # Part of a function in a Fixup, between two of its split points. start
+    # and end map sections to offsets, with '.late_rodata' offsets counted
+    # from the start of late rodata.
+    def __init__(self, function, start, end, asm_conts, late_rodata_asm_conts, first, last):
+        self.function = function
+        self.start = start
+        self.end = end
+        self.asm_conts = asm_conts
+        self.late_rodata_asm_conts = late_rodata_asm_conts
+        self.first = first
+        self.last = last
+
+def fixup_pieces(fixup):
+    # Split the functions of a Fixup at their split points, for assembling in
+    # shards.
+    pieces = []
+    late_pos = 0
+    for function, locs in fixup.functions:
+        sizes = {sectype: size for sectype, (_, size) in function.data.items()}
+        sizes['.late_rodata'] = late_rodata_size(function)
+        bounds = [((0, None), (0, None), dict.fromkeys(sizes, 0))]
+        for (ind, end, late_ind, late_end, text_size, other_sizes) in function.split_points:
+            point_sizes = dict(zip(SPLIT_POINT_SECTIONS, other_sizes))
+            point_sizes['.text'] = text_size
+            bounds.append(((ind, end), (late_ind, late_end), point_sizes))
+        bounds.append(((len(function.asm_conts), None), (len(function.late_rodata_asm_conts), None), sizes))
+        for k in range(len(bounds) - 1):
+            (asm0, late0, sizes0), (asm1, late1, sizes1) = bounds[k], bounds[k + 1]
+            start = {sectype: loc + sizes0[sectype] for sectype, loc in locs.items()}
+            end = {sectype: loc + sizes1[sectype] for sectype, loc in locs.items()}
+            start['.late_rodata'] = late_pos + sizes0['.late_rodata']
+            end['.late_rodata'] = late_pos + sizes1['.late_rodata']
+            pieces.append(FixupPiece(function, start, end,
+                conts_between(function.asm_conts, asm0, asm1),
+                conts_between(function.late_rodata_asm_conts, late0, late1),
+                k == 0, k == len(bounds) - 2))
+        late_pos += sizes['.late_rodata']
+    return pieces
+
+def shard_bounds(pieces, max_shards, min_size):
+    # Split a list of FixupPieces into up to max_shards contiguous ranges of
+    # similar size, but no smaller than min_size bytes. Returns a list of
+    # (start, end) indices.
+    weights = [sum(piece.end[sectype] - piece.start[sectype] for sectype in piece.start) for piece in pieces]
+    target = max(sum(weights) / max_shards, min_size)
+    bounds = []
+    start = 0
+    weight = 0
+    for i, w in enumerate(weights):
+        weight += w
+        if weight >= (len(bounds) + 1) * target and len(bounds) < max_shards - 1 and i + 1 < len(pieces):
+            bounds.append((start, i + 1))
+            start = i + 1
+    bounds.append((start, len(pieces)))
+    return bounds
+
+def shard_end_label(sectype):
+    return '_asmpp_shard_end' + sectype.replace('.', '_')
+
+def shard_asm(fixup, pieces, start, end):
+    """
+    The assembly for FixupPieces [start, end) of a Fixup, placed at the
+    same offsets as in fixup.asm by padding with .space, with late rodata
+    after fixup.rodata_end. Returns it together with where each section is
+    expected to end, which is marked with a label for assemble_sharded to
+    check.
+    """
+    # Make sure every section exists.
+    asm = ['.section ' + sectype for sectype in FIXUP_SECTIONS]
+    ends = dict.fromkeys(FIXUP_SECTIONS, 0)
+    for piece in pieces[start:end]:
+        for sectype in FIXUP_SECTIONS:
+            if sectype not in piece.start:
+                continue
+            if piece.start[sectype] != ends[sectype]:
+                asm.append('.section ' + sectype)
+                asm.append('.space {}'.format(piece.start[sectype] - ends[sectype]))
+            ends[sectype] = piece.end[sectype]
+        asm.extend(function_asm(piece.function, piece.asm_conts, piece.first, piece.last))
+    for sectype in FIXUP_SECTIONS:
+        asm.append('.section ' + sectype)
+        asm.append(shard_end_label(sectype) + ':')
+
+    late_inds = [i for i, piece in enumerate(pieces) if piece.late_rodata_asm_conts]
+    if any(start <= i < end for i in late_inds):
+        pos = fixup.rodata_end
+        asm.append('.rdata')
+        if pos != ends['.rodata']:
+            asm.append('.space {}'.format(pos - ends['.rodata']))
+        for i in late_inds:
+            if not start <= i < end:
+                continue
+            piece = pieces[i]
+            if i == late_inds[0]:
+                asm.append('glabel {}'.format(fixup.late_rodata_source_name_start))
+            if fixup.rodata_end + piece.start['.late_rodata'] != pos:
+                asm.append('.space {}'.format(fixup.rodata_end + piece.start['.late_rodata'] - pos))
+            asm.extend(piece.late_rodata_asm_conts)
+            pos = fixup.rodata_end + piece.end['.late_rodata']
+            if i == late_inds[-1]:
+                asm.append('glabel {}'.format(fixup.late_rodata_source_name_end))
+        asm.append(shard_end_label('.late_rodata') + ':')
+        ends['.late_rodata'] = pos
+    return asm, ends
+
+def assemble_sharded(fixup, pieces, bounds, asm_prelude, assembler, output_enc):
+    """
+    Assemble ranges of the FixupPieces of a Fixup as separate shards in
+    parallel, and combine them into an object file like that from assembling
+    fixup.asm: section contents are taken from the shard that owns them, and
+    symbols and relocations are concatenated in shard order, i.e. source
+    order. Raises Failure if the shards don't fit together.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    shard_asms = [shard_asm(fixup, pieces, start, end) for (start, end) in bounds]
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        shard_datas = list(executor.map(
+            lambda asm: run_assembler(asm, asm_prelude, assembler, output_enc, quiet=True), [asm for (asm, _) in shard_asms]))
+    shards = [ElfFile(data) for data in shard_datas]
+
+    # Check that the pieces had their expected sizes, and that shards only
+    # refer to each other's global symbols, in ways that don't depend on
+    # whether the symbol is defined in the same file.
+    defined = {}
+    for ind, (shard, (_, ends)) in enumerate(zip(shards, shard_asms)):
+        for sectype, pos in ends.items():
+            section = shard.find_section('.rodata' if sectype == '.late_rodata' else sectype)
+            if shard.symtab.find_symbol_in_section(shard_end_label(sectype), section) != pos:
+                raise Failure("unexpected section size in assembled shard")
+        for i, sym in enumerate(shard.symtab.symbol_entries):
+            if i != 0 and sym.st_shndx != SHN_UNDEF and sym.type not in [STT_SECTION, STT_FILE]:
+                defined[sym.name] = (ind, i >= shard.symtab.sh_info)
+    for ind, shard in enumerate(shards):
+        for sec in shard.sections:
+            if not sec.is_rel():
+                continue
+            for rel in sec.relocations:
+                sym = shard.symtab.symbol_entries[rel.sym_index]
+                if sym.st_shndx != SHN_UNDEF or sym.name not in defined:
+                    continue
+                if not defined[sym.name][1] or rel.rel_type not in [R_MIPS_32, R_MIPS_26, R_MIPS_HI16, R_MIPS_LO16]:
+                    raise Failure("assembled shards refer to each other's symbol " + sym.name)
+            check_hi16_pairs(sec)
+
+    base = shards[0]
+    # .reginfo gets the union of the shards' register masks.
+    reginfo = bytearray(base.find_section('.reginfo').data)
+    for shard in shards[1:]:
+        for i, b in enumerate(shard.find_section('.reginfo').data):
+            reginfo[i] |= b
+    base.find_section('.reginfo').data = bytes(reginfo)
+
+    contents = {sectype: bytearray() for sectype in FIXUP_SECTIONS if sectype != '.bss'}
+    for shard, (start, end) in zip(shards, bounds):
+        for piece in pieces[start:end]:
+            ranges = [(sectype, piece.start[sectype], piece.end[sectype]) for sectype in contents if sectype in piece.start]
+            ranges.append(('.rodata', fixup.rodata_end + piece.start['.late_rodata'], fixup.rodata_end + piece.end['.late_rodata']))
+            for sectype, pos, pos_end in ranges:
+                data = contents[sectype]
+                if len(data) < pos_end:
+                    data.extend(bytes(pos_end - len(data)))
+                data[pos:pos_end] = shard.find_section(sectype).data[pos:pos_end]
+    for sectype, data in contents.items():
+        base.find_section(sectype).data = bytes(data)
+
+    # Symbols, without our shard end labels, and with duplicates removed:
+    # section and file symbols, and globals referred to by several shards.
+    end_labels = set(shard_end_label(sectype) for sectype in FIXUP_SECTIONS + ['.late_rodata'])
+    local_syms = []
+    global_syms = []
+    seen = {}
+    new_indices = []
+    for shard in shards:
+        symtab = shard.symtab
+        indices = {0: (None, 0)}
+        for i, sym in enumerate(symtab.symbol_entries):
+            if i == 0 or sym.name in end_labels:
+                continue
+            is_local = (i < symtab.sh_info)
+            if sym.st_shndx != SHN_UNDEF and sym.st_shndx < SHN_LORESERVE:
+                section = base.find_section(shard.sections[sym.st_shndx].name)
+                if section is None:
+                    raise Failure("unexpected section in assembled shard: " + shard.sections[sym.st_shndx].name)
+                sym.st_shndx = section.index
+            syms = local_syms if is_local else global_syms
+            if is_local and sym.type not in [STT_SECTION, STT_FILE]:
+                key = None
+            else:
+                key = (is_local, sym.type, sym.name, sym.st_shndx if sym.type == STT_SECTION else None)
+            if key is None or key not in seen:
+                if key is not None:
+                    seen[key] = len(syms)
+                indices[i] = (syms, len(syms))
+                syms.append(sym)
+            else:
+                indices[i] = (syms, seen[key])
+                if sym.st_shndx != SHN_UNDEF:
+                    syms[seen[key]] = sym
+        new_indices.append(indices)
+    base.symtab.symbol_entries = base.symtab.symbol_entries[:1] + local_syms + global_syms
+    base.symtab.sh_info = 1 + len(local_syms)
+    def new_index(indices, i):
+        syms, ind = indices[i]
+        if syms is None:
+            return 0
+        return 1 + ind + (len(local_syms) if syms is global_syms else 0)
+
+    # Relocations. In .rodata, those for late rodata come after all others.
+    for sectype in FIXUP_SECTIONS:
+        reltabs = {}
+        for shard, indices in zip(shards, new_indices):
+            for reltab in shard.find_section(sectype).relocated_by:
+                relocations = reltabs.setdefault(reltab.sh_type, (reltab, []))[1]
+                for rel in reltab.relocations:
+                    rel.sym_index = new_index(indices, rel.sym_index)
+                    relocations.append(rel)
+        for reltab, relocations in reltabs.values():
+            if sectype == '.rodata':
+                relocations.sort(key=lambda rel: rel.r_offset >= fixup.rodata_end)
+            reltab.relocations = relocations
+        base.find_section(sectype).relocated_by = [reltab for (reltab, _) in reltabs.values()]
+    return base
+
+def check_hi16_pairs(reltab):
+    # The assembler moves each %hi relocation to just before the matching %lo
+    # one, so if a shard was cut between the two, its relocations would end up
+    # in a different order than when assembling everything at once. Require
+    # each run of R_MIPS_HI16 to be followed by an R_MIPS_LO16 against the
+    # same symbol.
+    hi_sym = None
+    for rel in reltab.relocations:
+        if rel.rel_type == R_MIPS_HI16 and hi_sym in [None, rel.sym_index]:
+            hi_sym = rel.sym_index
+        elif rel.rel_type == R_MIPS_LO16 and rel.sym_index == hi_sym:
+            hi_sym = None
+        elif hi_sym is not None:
+            break
+    if hi_sym is not None:
+        raise Failure("%hi relocation without a matching %lo in assembled shard")
+
+def run_assembler(asm, asm_prelude, assembler, output_enc, quiet=False):
+    # Assemble a list of lines, returning the contents of the object file.
+    # If quiet, the assembler's error output is discarded.
+    import tempfile
     o_file = tempfile.NamedTemporaryFile(prefix='asm-processor', suffix='.o', delete=False)
     o_name = o_file.name
     o_file.close()
@@ -903,210 +2176,889 @@ def fixup_objfile(objfile_name, functions, asm_prelude, assembler, output_enc):
     s_name = s_file.name
     try:
         s_file.write(asm_prelude + b'\n')
-        for line in asm:
+        for line in iter_asm_lines(asm):
             s_file.write(line.encode(output_enc) + b'\n')
         s_file.close()
-        ret = os.system(assembler + " " + s_name + " -o " + o_name)
+        ret = os.system(assembler + " " + s_name + " -o " + o_name + (" 2>" + os.devnull if quiet else ""))
         if ret != 0:
             raise Failure("failed to assemble")
         with open(o_name, 'rb') as f:
-            asm_objfile = ElfFile(f.read())
-
-        # Remove some clutter from objdump output
-        objfile.drop_irrelevant_sections()
-
-        # Unify reginfo sections
-        target_reginfo = objfile.find_section('.reginfo')
-        source_reginfo_data = list(asm_objfile.find_section('.reginfo').data)
-        data = list(target_reginfo.data)
-        for i in range(20):
-            data[i] |= source_reginfo_data[i]
-        target_reginfo.data = bytes(data)
-
-        # Move over section contents
-        modified_text_positions = set()
-        jtbl_rodata_positions = set()
-        last_rodata_pos = 0
-        for sectype in SECTIONS:
-            if not to_copy[sectype]:
-                continue
-            source = asm_objfile.find_section(sectype)
-            assert source is not None, "didn't find source section: " + sectype
-            for (pos, count, temp_name, fn_desc) in to_copy[sectype]:
-                loc1 = asm_objfile.symtab.find_symbol_in_section(temp_name + '_asm_start', source)
-                loc2 = asm_objfile.symtab.find_symbol_in_section(temp_name + '_asm_end', source)
-                assert loc1 == pos, "assembly and C files don't line up for section " + sectype + ", " + fn_desc
-                if loc2 - loc1 != count:
-                    raise Failure("incorrectly computed size for section " + sectype + ", " + fn_desc + ". If using .double, make sure to provide explicit alignment padding.")
-            if sectype == '.bss':
+            return f.read()
+    finally:
+        s_file.close()
+        os.remove(s_name)
+        try:
+            os.remove(o_name)
+        except:
+            pass
+
+def merge_fixup(fixup, asm_objfile):
+    # Merge the assembled code into the object file, returning its new contents.
+    objfile = fixup.objfile
+    to_copy = fixup.to_copy
+    all_text_glabels = fixup.all_text_glabels
+    all_late_rodata_dummy_bytes = fixup.all_late_rodata_dummy_bytes
+    all_jtbl_rodata_size = fixup.all_jtbl_rodata_size
+    late_rodata_source_name_start = fixup.late_rodata_source_name_start
+    late_rodata_source_name_end = fixup.late_rodata_source_name_end
+
+    # Remove some clutter from objdump output
+    objfile.drop_irrelevant_sections()
+
+    # Unify reginfo sections
+    target_reginfo = objfile.find_section('.reginfo')
+    source_reginfo_data = list(asm_objfile.find_section('.reginfo').data)
+    data = list(target_reginfo.data)
+    for i in range(20):
+        data[i] |= source_reginfo_data[i]
+    target_reginfo.data = bytes(data)
+
+    # Move over section contents
+    modified_text_positions = RangeSet()
+    jtbl_rodata_positions = RangeSet()
+    last_rodata_pos = 0
+    for sectype in FIXUP_SECTIONS:
+        if not to_copy[sectype]:
+            continue
+        source = asm_objfile.find_section(sectype)
+        assert source is not None, "didn't find source section: " + sectype
+        for (pos, count, temp_name, fn_desc, _) in to_copy[sectype]:
+            loc1 = asm_objfile.symtab.find_symbol_in_section(temp_name + '_asm_start', source)
+            loc2 = asm_objfile.symtab.find_symbol_in_section(temp_name + '_asm_end', source)
+            assert loc1 == pos, "assembly and C files don't line up for section " + sectype + ", " + fn_desc
+            if loc2 - loc1 != count:
+                raise Failure("incorrectly computed size for section " + sectype + ", " + fn_desc + ". If using .double, make sure to provide explicit alignment padding.")
+        if sectype == '.bss':
+            continue
+        target = objfile.find_section(sectype)
+        assert target is not None, "missing target section of type " + sectype
+        data = bytearray(target.data)
+        for (pos, count, _, fn_desc, incbins) in to_copy[sectype]:
+            data[pos:pos + count] = source.data[pos:pos + count]
+            for (offset, path, skip, size) in incbins:
+                copy_incbin(data, pos + offset, path, skip, size, fn_desc)
+            if sectype == '.text':
+                assert count % 4 == 0
+                assert pos % 4 == 0
+                modified_text_positions.add(pos, pos + count)
+            elif sectype == '.rodata':
+                last_rodata_pos = pos + count
+        target.data = bytes(data)
+
+    # Move over late rodata. This is heuristic, sadly, since I can't think
+    # of another way of doing it.
+    moved_late_rodata = {}
+    if any(all_late_rodata_dummy_bytes) or any(all_jtbl_rodata_size):
+        source = asm_objfile.find_section('.rodata')
+        target = objfile.find_section('.rodata')
+        source_pos = asm_objfile.symtab.find_symbol_in_section(late_rodata_source_name_start, source)
+        source_end = asm_objfile.symtab.find_symbol_in_section(late_rodata_source_name_end, source)
+        if source_end - source_pos != sum(map(len, all_late_rodata_dummy_bytes)) * 4 + sum(all_jtbl_rodata_size):
+            raise Failure("computed wrong size of .late_rodata")
+        new_data = bytearray(target.data)
+        for dummy_bytes_list, jtbl_rodata_size in zip(all_late_rodata_dummy_bytes, all_jtbl_rodata_size):
+            for index, dummy_bytes in enumerate(dummy_bytes_list):
+                pos = target.data.index(dummy_bytes, last_rodata_pos)
+                # This check is nice, but makes time complexity worse for large files:
+                if SLOW_CHECKS and target.data.find(dummy_bytes, pos + 4) != -1:
+                    raise Failure("multiple occurrences of late_rodata hex magic. Change asm-processor to use something better than 0xE0123456!")
+                if index == 0 and len(dummy_bytes_list) > 1 and target.data[pos+4:pos+8] == b'\0\0\0\0':
+                    # Ugly hack to handle double alignment for non-matching builds.
+                    # We were told by .late_rodata_alignment (or deduced from a .double)
+                    # that a function's late_rodata started out 4 (mod 8), and emitted
+                    # a float and then a double. But it was actually 0 (mod 8), so our
+                    # double was moved by 4 bytes. To make them adjacent to keep jump
+                    # tables correct, move the float by 4 bytes as well.
+                    new_data[pos:pos+4] = b'\0\0\0\0'
+                    pos += 4
+                new_data[pos:pos+4] = source.data[source_pos:source_pos+4]
+                moved_late_rodata[source_pos] = pos
+                last_rodata_pos = pos + 4
+                source_pos += 4
+            if jtbl_rodata_size > 0:
+                assert dummy_bytes_list, "should always have dummy bytes before jtbl data"
+                pos = last_rodata_pos
+                new_data[pos : pos + jtbl_rodata_size] = \
+                    source.data[source_pos : source_pos + jtbl_rodata_size]
+                for i in range(0, jtbl_rodata_size, 4):
+                    moved_late_rodata[source_pos + i] = pos + i
+                jtbl_rodata_positions.add(pos, pos + jtbl_rodata_size)
+                last_rodata_pos += jtbl_rodata_size
+                source_pos += jtbl_rodata_size
+        target.data = bytes(new_data)
+
+    # Find relocated symbols
+    relocated_symbols = set()
+    for sectype in FIXUP_SECTIONS:
+        for obj in [asm_objfile, objfile]:
+            sec = obj.find_section(sectype)
+            if sec is None:
                 continue
-            target = objfile.find_section(sectype)
-            assert target is not None, "missing target section of type " + sectype
-            data = list(target.data)
-            for (pos, count, _, _) in to_copy[sectype]:
-                data[pos:pos + count] = source.data[pos:pos + count]
-                if sectype == '.text':
-                    assert count % 4 == 0
-                    assert pos % 4 == 0
-                    for i in range(count // 4):
-                        modified_text_positions.add(pos + 4 * i)
-                elif sectype == '.rodata':
-                    last_rodata_pos = pos + count
-            target.data = bytes(data)
-
-        # Move over late rodata. This is heuristic, sadly, since I can't think
-        # of another way of doing it.
-        moved_late_rodata = {}
-        if any(all_late_rodata_dummy_bytes) or any(all_jtbl_rodata_size):
-            source = asm_objfile.find_section('.rodata')
-            target = objfile.find_section('.rodata')
-            source_pos = asm_objfile.symtab.find_symbol_in_section(late_rodata_source_name_start, source)
-            source_end = asm_objfile.symtab.find_symbol_in_section(late_rodata_source_name_end, source)
-            if source_end - source_pos != sum(map(len, all_late_rodata_dummy_bytes)) * 4 + sum(all_jtbl_rodata_size):
-                raise Failure("computed wrong size of .late_rodata")
-            new_data = list(target.data)
-            for dummy_bytes_list, jtbl_rodata_size in zip(all_late_rodata_dummy_bytes, all_jtbl_rodata_size):
-                for index, dummy_bytes in enumerate(dummy_bytes_list):
-                    pos = target.data.index(dummy_bytes, last_rodata_pos)
-                    # This check is nice, but makes time complexity worse for large files:
-                    if SLOW_CHECKS and target.data.find(dummy_bytes, pos + 4) != -1:
-                        raise Failure("multiple occurrences of late_rodata hex magic. Change asm-processor to use something better than 0xE0123456!")
-                    if index == 0 and len(dummy_bytes_list) > 1 and target.data[pos+4:pos+8] == b'\0\0\0\0':
-                        # Ugly hack to handle double alignment for non-matching builds.
-                        # We were told by .late_rodata_alignment (or deduced from a .double)
-                        # that a function's late_rodata started out 4 (mod 8), and emitted
-                        # a float and then a double. But it was actually 0 (mod 8), so our
-                        # double was moved by 4 bytes. To make them adjacent to keep jump
-                        # tables correct, move the float by 4 bytes as well.
-                        new_data[pos:pos+4] = b'\0\0\0\0'
-                        pos += 4
-                    new_data[pos:pos+4] = source.data[source_pos:source_pos+4]
-                    moved_late_rodata[source_pos] = pos
-                    last_rodata_pos = pos + 4
-                    source_pos += 4
-                if jtbl_rodata_size > 0:
-                    assert dummy_bytes_list, "should always have dummy bytes before jtbl data"
-                    pos = last_rodata_pos
-                    new_data[pos : pos + jtbl_rodata_size] = \
-                        source.data[source_pos : source_pos + jtbl_rodata_size]
-                    for i in range(0, jtbl_rodata_size, 4):
-                        moved_late_rodata[source_pos + i] = pos + i
-                        jtbl_rodata_positions.add(pos + i)
-                    last_rodata_pos += jtbl_rodata_size
-                    source_pos += jtbl_rodata_size
-            target.data = bytes(new_data)
-
-        # Merge strtab data.
-        strtab_adj = len(objfile.symtab.strtab.data)
-        objfile.symtab.strtab.data += asm_objfile.symtab.strtab.data
-
-        # Find relocated symbols
-        relocated_symbols = set()
-        for sectype in SECTIONS:
-            for obj in [asm_objfile, objfile]:
-                sec = obj.find_section(sectype)
-                if sec is None:
-                    continue
-                for reltab in sec.relocated_by:
-                    for rel in reltab.relocations:
-                        relocated_symbols.add(obj.symtab.symbol_entries[rel.sym_index])
-
-        # Move over symbols, deleting the temporary function labels.
-        # Sometimes this naive procedure results in duplicate symbols, or UNDEF
-        # symbols that are also defined the same .o file. Hopefully that's fine.
-        # Skip over local symbols that aren't used relocated against, to avoid
-        # conflicts.
-        new_local_syms = [s for s in objfile.symtab.local_symbols() if not is_temp_name(s.name)]
-        new_global_syms = [s for s in objfile.symtab.global_symbols() if not is_temp_name(s.name)]
-        for i, s in enumerate(asm_objfile.symtab.symbol_entries):
-            is_local = (i < asm_objfile.symtab.sh_info)
-            if is_local and s not in relocated_symbols:
+            for reltab in sec.relocated_by:
+                for rel in reltab.relocations:
+                    relocated_symbols.add(obj.symtab.symbol_entries[rel.sym_index])
+
+    # Move over symbols, deleting the temporary function labels.
+    # Sometimes this naive procedure results in duplicate symbols, or UNDEF
+    # symbols that are also defined the same .o file. Hopefully that's fine.
+    # Skip over local symbols that aren't used relocated against, to avoid
+    # conflicts.
+    new_local_syms = [s for s in objfile.symtab.local_symbols() if not is_temp_name(s.name)]
+    new_global_syms = [s for s in objfile.symtab.global_symbols() if not is_temp_name(s.name)]
+    for i, s in enumerate(asm_objfile.symtab.symbol_entries):
+        is_local = (i < asm_objfile.symtab.sh_info)
+        if is_local and s not in relocated_symbols:
+            continue
+        if is_temp_name(s.name):
+            continue
+        if s.st_shndx not in [SHN_UNDEF, SHN_ABS]:
+            section_name = asm_objfile.sections[s.st_shndx].name
+            if section_name not in FIXUP_SECTIONS:
+                raise Failure("generated assembly .o must only have symbols for .text, .data, .rodata, ABS and UNDEF, but found " + section_name)
+            s.st_shndx = objfile.find_section(section_name).index
+            # glabel's aren't marked as functions, making objdump output confusing. Fix that.
+            if s.name in all_text_glabels:
+                s.type = STT_FUNC
+            if objfile.sections[s.st_shndx].name == '.rodata' and s.st_value in moved_late_rodata:
+                s.st_value = moved_late_rodata[s.st_value]
+        if is_local:
+            new_local_syms.append(s)
+        else:
+            new_global_syms.append(s)
+    new_syms = new_local_syms + new_global_syms
+    for i, s in enumerate(new_syms):
+        s.new_index = i
+    write_symbols(objfile, new_syms, len(new_local_syms))
+
+    # Move over relocations
+    for sectype in FIXUP_SECTIONS:
+        source = asm_objfile.find_section(sectype)
+        target = objfile.find_section(sectype)
+
+        if target is not None:
+            # fixup relocation symbol indices, since we butchered them above
+            for reltab in target.relocated_by:
+                nrels = []
+                for rel in reltab.relocations:
+                    if (sectype == '.text' and rel.r_offset in modified_text_positions or
+                        sectype == '.rodata' and rel.r_offset in jtbl_rodata_positions):
+                        # don't include relocations for late_rodata dummy code
+                        continue
+                    # hopefully we don't have relocations for local or
+                    # temporary symbols, so new_index exists
+                    rel.sym_index = objfile.symtab.symbol_entries[rel.sym_index].new_index
+                    nrels.append(rel)
+                reltab.relocations = nrels
+                reltab.data = relocations_to_bin(nrels, reltab.sh_type)
+
+        if not source:
+            continue
+
+        target_reltab = objfile.find_section('.rel' + sectype)
+        target_reltaba = objfile.find_section('.rela' + sectype)
+        for reltab in source.relocated_by:
+            for rel in reltab.relocations:
+                rel.sym_index = asm_objfile.symtab.symbol_entries[rel.sym_index].new_index
+                if sectype == '.rodata' and rel.r_offset in moved_late_rodata:
+                    rel.r_offset = moved_late_rodata[rel.r_offset]
+            new_data = relocations_to_bin(reltab.relocations, reltab.sh_type)
+            if reltab.sh_type == SHT_REL:
+                if not target_reltab:
+                    target_reltab = objfile.add_section('.rel' + sectype,
+                            sh_type=SHT_REL, sh_flags=0,
+                            sh_link=objfile.symtab.index, sh_info=target.index,
+                            sh_addralign=4, sh_entsize=8, data=b'')
+                target_reltab.data += new_data
+            else:
+                if not target_reltaba:
+                    target_reltaba = objfile.add_section('.rela' + sectype,
+                            sh_type=SHT_RELA, sh_flags=0,
+                            sh_link=objfile.symtab.index, sh_info=target.index,
+                            sh_addralign=4, sh_entsize=12, data=b'')
+                target_reltaba.data += new_data
+
+    return objfile.to_bin()
+
+# Section flags used when assembling several files at once, which puts the
+# sections of each file in sections of their own, e.g. .text.asmpp3.
+BATCH_SECTION_FLAGS = {
+    '.text': '"ax",@progbits',
+    '.data': '"aw",@progbits',
+    '.rodata': '"a",@progbits',
+    '.bss': '"aw",@nobits',
+}
+
+def parse_asm_line(line, regexes):
+    # Returns an asm line without comments and strings, and its label, if any.
+    line = regexes.comment_or_string.sub(re_comment_replacer, line).strip()
+    m = regexes.asm_label.match(line)
+    if m:
+        return line[m.end():], m.group(1)
+    if line.startswith('glabel '):
+        return '', line.split()[1]
+    return line, None
+
+def batch_symbols(fixup):
+    # Returns the labels defined by the assembly of a Fixup, and all names it
+    # mentions (conservatively, any identifier-like token), or None if the
+    # assembly changes assembler state that would carry over to other files.
+    regexes = compiled_regexes()
+    defined = set()
+    mentioned = set()
+    for line in iter_asm_lines(fixup.asm):
+        if line.startswith('glabel _asmpp_'):
+            continue
+        code, label = parse_asm_line(line, regexes)
+        if code.startswith('.set') or code.startswith('.equ') or code.startswith('.eqv') or regexes.assignment.match(code):
+            return None
+        if label is not None:
+            defined.add(label)
+            mentioned.add(label)
+        mentioned.update(regexes.identifier.findall(code))
+    return defined, mentioned
+
+def batch_groups(fixups, max_size):
+    """
+    Split a list of Fixups into groups of indices whose assembly can share an
+    assembler run. We can't rename user labels, so files go into the same
+    group only if none of them mentions a label that another one defines.
+    Files that use .set or assign symbols are always assembled on their own.
+    """
+    groups = []
+    for i, fixup in enumerate(fixups):
+        symbols = batch_symbols(fixup)
+        if symbols is None:
+            groups.append(([i], None, None))
+            continue
+        defined, mentioned = symbols
+        for group in groups:
+            if group[1] is None:
                 continue
-            if is_temp_name(s.name):
+            if (len(group[0]) < max_size and not defined & group[2] and
+                    not mentioned & group[1]):
+                group[0].append(i)
+                group[1].update(defined)
+                group[2].update(mentioned)
+                break
+        else:
+            groups.append(([i], set(defined), set(mentioned)))
+    return [group[0] for group in groups]
+
+def batch_asm(fixups):
+    # Yields the combined assembly of several Fixups, with the sections and
+    # temporary labels of the n'th renamed to .text.asmpp<n>, _asmpp_tu<n>_*.
+    regexes = compiled_regexes()
+    for tu, fixup in enumerate(fixups):
+        for line in iter_asm_lines(fixup.asm):
+            if line.startswith('glabel _asmpp_'):
+                yield 'glabel _asmpp_tu{}_'.format(tu) + line[len('glabel _asmpp_'):]
                 continue
-            if s.st_shndx not in [SHN_UNDEF, SHN_ABS]:
-                section_name = asm_objfile.sections[s.st_shndx].name
-                if section_name not in SECTIONS:
-                    raise Failure("generated assembly .o must only have symbols for .text, .data, .rodata, ABS and UNDEF, but found " + section_name)
-                s.st_shndx = objfile.find_section(section_name).index
-                # glabel's aren't marked as functions, making objdump output confusing. Fix that.
-                if s.name in all_text_glabels:
-                    s.type = STT_FUNC
-                if objfile.sections[s.st_shndx].name == '.rodata' and s.st_value in moved_late_rodata:
-                    s.st_value = moved_late_rodata[s.st_value]
-            s.st_name += strtab_adj
-            if is_local:
-                new_local_syms.append(s)
+            code, label = parse_asm_line(line, regexes)
+            if code.startswith('.section') or code in ['.text', '.data', '.rdata', '.rodata', '.bss']:
+                sectype = '.rodata' if code == '.rdata' else code.split(',')[0].split()[-1]
+                if label is not None:
+                    yield label + ':'
+                yield '.section {}.asmpp{},{}'.format(sectype, tu, BATCH_SECTION_FLAGS[sectype])
             else:
-                new_global_syms.append(s)
-        new_syms = new_local_syms + new_global_syms
-        for i, s in enumerate(new_syms):
-            s.new_index = i
-        objfile.symtab.data = b''.join(s.to_bin() for s in new_syms)
-        objfile.symtab.sh_info = len(new_local_syms)
-
-        # Move over relocations
-        for sectype in SECTIONS:
-            source = asm_objfile.find_section(sectype)
-            target = objfile.find_section(sectype)
-
-            if target is not None:
-                # fixup relocation symbol indices, since we butchered them above
-                for reltab in target.relocated_by:
-                    nrels = []
-                    for rel in reltab.relocations:
-                        if (sectype == '.text' and rel.r_offset in modified_text_positions or
-                            sectype == '.rodata' and rel.r_offset in jtbl_rodata_positions):
-                            # don't include relocations for late_rodata dummy code
-                            continue
-                        # hopefully we don't have relocations for local or
-                        # temporary symbols, so new_index exists
-                        rel.sym_index = objfile.symtab.symbol_entries[rel.sym_index].new_index
-                        nrels.append(rel)
-                    reltab.relocations = nrels
-                    reltab.data = b''.join(rel.to_bin() for rel in nrels)
-
-            if not source:
+                yield line
+
+def batch_reginfo(asm_objfile, num_tus):
+    # Returns the .reginfo contents for each Fixup of a batch_asm object
+    # file, with register masks computed from that file's own code, or None
+    # if those don't add up to the masks the assembler computed for the
+    # batch (in which case we can't tell which file uses which registers).
+    reginfo = asm_objfile.find_section('.reginfo').data
+    masks = []
+    for tu in range(num_tus):
+        text = asm_objfile.find_section('.text.asmpp{}'.format(tu))
+        masks.append(code_register_masks(text.data if text is not None else b''))
+    gprs = 0
+    fprs = 0
+    for gpr_mask, fpr_mask in masks:
+        gprs |= gpr_mask
+        fprs |= fpr_mask
+    # The other coprocessor masks and the gp value are expected to be zero.
+    if struct.pack('>IIIIII', gprs, 0, fprs, 0, 0, 0) != reginfo:
+        return None
+    return [struct.pack('>IIIIII', gpr_mask, 0, fpr_mask, 0, 0, 0) for gpr_mask, fpr_mask in masks]
+
+def batch_view(asm_objfile_data, tu, reginfo):
+    """
+    Returns the part of an object file assembled from batch_asm that belongs
+    to the tu'th Fixup, looking like it was assembled on its own: only its
+    sections, under their usual names, its symbols, its relocations and the
+    given .reginfo contents.
+    """
+    asm_objfile = ElfFile(asm_objfile_data)
+    asm_objfile.find_section('.reginfo').data = reginfo
+    suffix = '.asmpp{}'.format(tu)
+    own_sections = set()
+    for sec in asm_objfile.sections:
+        if sec.name.endswith(suffix) and sec.name[:-len(suffix)] in FIXUP_SECTIONS:
+            sec.name = sec.name[:-len(suffix)]
+            own_sections.add(sec.index)
+        elif sec.name in FIXUP_SECTIONS:
+            # Empty default sections, which no file uses.
+            sec.name += '.unused'
+    reltabs = [sec for sec in asm_objfile.sections if sec.is_rel() and sec.sh_info in own_sections]
+    referenced = set(rel.sym_index for reltab in reltabs for rel in reltab.relocations)
+    symtab = asm_objfile.symtab
+    prefix = '_asmpp_tu{}_'.format(tu)
+    new_indices = {}
+    new_syms = []
+    num_local_syms = 0
+    for i, s in enumerate(symtab.symbol_entries):
+        if i != 0 and s.st_shndx not in own_sections and i not in referenced:
+            continue
+        if s.name.startswith(prefix):
+            s.name = '_asmpp_' + s.name[len(prefix):]
+        new_indices[i] = len(new_syms)
+        new_syms.append(s)
+        if i < symtab.sh_info:
+            num_local_syms += 1
+    for reltab in reltabs:
+        for rel in reltab.relocations:
+            rel.sym_index = new_indices[rel.sym_index]
+    symtab.symbol_entries = new_syms
+    symtab.sh_info = num_local_syms
+    return asm_objfile
+
+def postprocess_batch(items, assembler, asm_prelude=b'', output_enc='latin1', max_batch=16, assemble_shards=1, shared=None, assemble_shard_size=None):
+    """
+    Like postprocess, for a list of (obj_bytes, functions) pairs, but running
+    the assembler once for up to max_batch files at a time. Returns a list
+    with the new object file contents, or a Failure, for each item. Files
+    that end up assembled on their own use assemble_shards and
+    assemble_shard_size as for postprocess.
+    If shared is a list, it gets a bool for each item, telling whether its
+    output came from an assembler run shared with other files.
+
+    Each output gets the .reginfo register masks of its own code, computed
+    by code_register_masks. If these don't match what the assembler computed
+    for the batch, the files are assembled one by one instead.
+    """
+    results = [None] * len(items)
+    if shared is not None:
+        shared[:] = [False] * len(items)
+    fixups = []
+    for ind, (obj_bytes, functions) in enumerate(items):
+        if not functions:
+            results[ind] = obj_bytes
+            continue
+        try:
+            fixups.append((ind, prepare_fixup(obj_bytes, functions)))
+        except Failure as e:
+            results[ind] = e
+    for group in batch_groups([fixup for (_, fixup) in fixups], max_batch):
+        group = [fixups[i] for i in group]
+        try:
+            if len(group) == 1:
+                ind, fixup = group[0]
+                asm_objfile = assemble_fixup(fixup, asm_prelude, assembler, output_enc, assemble_shards, assemble_shard_size)
+                results[ind] = merge_fixup(fixup, asm_objfile)
                 continue
+            asm_objfile_data = run_assembler(batch_asm([fixup for (_, fixup) in group]), asm_prelude, assembler, output_enc)
+            reginfos = batch_reginfo(ElfFile(asm_objfile_data), len(group))
+        except Failure as e:
+            if len(group) == 1:
+                results[group[0][0]] = e
+                continue
+            # Redo the files one by one, to find out which of them failed.
+            reginfos = None
+        if reginfos is None:
+            for ind, fixup in group:
+                try:
+                    results[ind] = postprocess(items[ind][0], items[ind][1], assembler, asm_prelude, output_enc,
+                            assemble_shards=assemble_shards, assemble_shard_size=assemble_shard_size)
+                except Failure as e2:
+                    results[ind] = e2
+            continue
+        for tu, (ind, fixup) in enumerate(group):
+            try:
+                results[ind] = merge_fixup(fixup, batch_view(asm_objfile_data, tu, reginfos[tu]))
+                if shared is not None:
+                    shared[ind] = True
+            except Failure as e:
+                results[ind] = e
+    return results
+
+VALIDATED_SECTIONS = ['.text', '.data', '.rodata', '.bss']
+
+# With --assemble-shards, GLOBAL_ASM blocks may be cut at a glabel after this
+# many bytes of .text (or anywhere after 8 times as many), and shards are at
+# least MIN_ASSEMBLE_SHARD_SIZE bytes by default (see --assemble-shard-size).
+ASSEMBLE_SPLIT_SIZE = 0x20
+MIN_ASSEMBLE_SHARD_SIZE = 0x10000
+# Sections other than .text whose sizes are recorded at each split point.
+SPLIT_POINT_SECTIONS = ['.data', '.bss', '.rodata', '.late_rodata']
+
+def assemble_block_sizes(function, offsets, asm_prelude, assembler, output_enc):
+    # Assemble a single block on its own, and measure its sections using
+    # start/end labels (section sizes themselves may include padding). Each
+    # section, and late rodata, starts at the given offset mod 8, see
+    # validate_sizes.
+    asm = []
+    for sectype, offset in zip(VALIDATED_SECTIONS, offsets):
+        asm.append('.section ' + sectype)
+        if offset:
+            asm.append('.space {}'.format(offset))
+        asm.append('glabel _asmpp_validate' + sectype[1:] + '_start')
+    asm.append('.text')
+    asm.extend(function.asm_conts)
+    for sectype in VALIDATED_SECTIONS:
+        asm.append('.section ' + sectype)
+        asm.append('glabel _asmpp_validate' + sectype[1:] + '_end')
+    asm.append('.rdata')
+    asm.append('.balign 8')
+    if offsets[-1]:
+        asm.append('.space {}'.format(offsets[-1]))
+    asm.append('glabel _asmpp_validate_late_rodata_start')
+    asm.extend(function.late_rodata_asm_conts)
+    asm.append('glabel _asmpp_validate_late_rodata_end')
 
-            target_reltab = objfile.find_section('.rel' + sectype)
-            target_reltaba = objfile.find_section('.rela' + sectype)
-            for reltab in source.relocated_by:
-                for rel in reltab.relocations:
-                    rel.sym_index = asm_objfile.symtab.symbol_entries[rel.sym_index].new_index
-                    if sectype == '.rodata' and rel.r_offset in moved_late_rodata:
-                        rel.r_offset = moved_late_rodata[rel.r_offset]
-                new_data = b''.join(rel.to_bin() for rel in reltab.relocations)
-                if reltab.sh_type == SHT_REL:
-                    if not target_reltab:
-                        target_reltab = objfile.add_section('.rel' + sectype,
-                                sh_type=SHT_REL, sh_flags=0,
-                                sh_link=objfile.symtab.index, sh_info=target.index,
-                                sh_addralign=4, sh_entsize=8, data=b'')
-                    target_reltab.data += new_data
-                else:
-                    if not target_reltaba:
-                        target_reltaba = objfile.add_section('.rela' + sectype,
-                                sh_type=SHT_RELA, sh_flags=0,
-                                sh_link=objfile.symtab.index, sh_info=target.index,
-                                sh_addralign=4, sh_entsize=12, data=b'')
-                    target_reltaba.data += new_data
-
-        objfile.write(objfile_name)
-    finally:
-        s_file.close()
-        os.remove(s_name)
+    try:
+        asm_objfile = ElfFile(run_assembler(asm, asm_prelude, assembler, output_enc))
+    except Failure:
+        return None
+    sizes = []
+    for name in [sectype[1:] for sectype in VALIDATED_SECTIONS] + ['_late_rodata']:
+        start = asm_objfile.symtab.find_symbol('_asmpp_validate' + name + '_start')
+        end = asm_objfile.symtab.find_symbol('_asmpp_validate' + name + '_end')
+        sizes.append(end[1] - start[1])
+    return sizes
+
+def validate_sizes(functions, asm_prelude, assembler, output_enc, jobs=1, object_cache=None):
+    """
+    Check the section sizes computed for each GLOBAL_ASM block by assembling
+    the blocks individually, so that mistakes are caught before the (slow)
+    compile rather than in fixup_objfile. Results are cached by block
+    contents, in object_cache if given.
+    """
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+    # Alignment may make sizes depend on where a block ends up, so each block
+    # is assembled at its offsets in the assembly that fixup_objfile builds,
+    # as far as they are known before compiling: after the previous blocks in
+    # each section, with late rodata following all of the rodata. Only the
+    # offsets mod 8 matter, as no larger alignment is supported.
+    ends = dict.fromkeys(VALIDATED_SECTIONS, 0)
+    late_rodata_end = sum(function.data['.rodata'][1] for function in functions)
+    all_offsets = []
+    keys = []
+    for function in functions:
+        offsets = [ends[sectype] % 8 for sectype in VALIDATED_SECTIONS] + [late_rodata_end % 8]
+        for sectype in VALIDATED_SECTIONS:
+            ends[sectype] += function.data[sectype][1]
+        late_rodata_end += late_rodata_size(function)
+        h = hashlib.sha256()
+        h.update(assembler.encode('utf-8') + b'\0' + asm_prelude + b'\0')
+        h.update(repr(offsets).encode('ascii') + b'\0')
+        hash_asm_lines(h, function.asm_conts, output_enc)
+        hash_asm_lines(h, function.late_rodata_asm_conts, output_enc)
+        all_offsets.append(offsets)
+        keys.append(h.hexdigest())
+
+    sizes_by_key = {}
+    to_assemble = {}
+    for key, function, offsets in zip(keys, functions, all_offsets):
+        if key in sizes_by_key or key in to_assemble:
+            continue
+        data = object_cache.get(key, '.sizes') if object_cache is not None else None
+        if data is not None:
+            sizes_by_key[key] = [int(x) for x in data.split()]
+        else:
+            to_assemble[key] = (function, offsets)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(lambda item: assemble_block_sizes(item[0], item[1], asm_prelude, assembler, output_enc), to_assemble.values())
+        for key, sizes in zip(to_assemble, results):
+            sizes_by_key[key] = sizes
+            if sizes is not None and object_cache is not None:
+                object_cache.put(key, ' '.join(map(str, sizes)).encode('ascii'), '.sizes')
+
+    for key, function in zip(keys, functions):
+        sizes = sizes_by_key[key]
+        if sizes is None:
+            # This can happen for blocks that e.g. branch to labels in other
+            # blocks. Leave it to the real post-processing step.
+            print("Warning: could not assemble " + function.fn_desc + " on its own, not validating its size", file=sys.stderr)
+            continue
+        expected = [function.data[sectype][1] for sectype in VALIDATED_SECTIONS]
+        expected.append(len(function.late_rodata_dummy_bytes) * 4 + function.jtbl_rodata_size)
+        for name, size, real_size in zip(VALIDATED_SECTIONS + ['.late_rodata'], expected, sizes):
+            if size != real_size:
+                raise Failure("incorrectly computed size for section {}, {} (computed {}, assembler gives {}). If using .double, make sure to provide explicit alignment padding.".format(name, function.fn_desc, size, real_size))
+
+class Options:
+    def __init__(self, opt, framepointer=False, input_enc='latin1', output_enc='latin1', filename='', max_fn_size=MAX_FN_SIZE, jtbl_instr_count=None, jobs=1, size_probe=None, assemble_shards=1):
+        self.opt = opt
+        self.framepointer = framepointer
+        self.input_enc = input_enc
+        self.output_enc = output_enc
+        self.filename = filename
+        self.max_fn_size = max_fn_size
+        self.jtbl_instr_count = jtbl_instr_count
+        self.jobs = jobs
+        self.size_probe = size_probe
+        self.assemble_shards = assemble_shards
+
+def preprocess(source, options):
+    """
+    Pre-process C source (bytes), returning the C code to pass to the compiler
+    (bytes) and the list of functions to later pass to postprocess.
+
+    options.opt is one of 'O1', 'O2', 'g' or 'g3' (for -O2 -g3). options.filename
+    is used to locate EARLY includes. options.assemble_shards should match what
+    is later passed to postprocess. Nothing is written to disk and no state
+    is shared between calls, so this may be called from several threads.
+    """
+    return preprocess_variants(source, [options])[0]
+
+def preprocess_variants(source, options_list):
+    """
+    Like preprocess, but for several Options at once, returning a list of
+    (C code, functions) pairs. The source is only parsed once. The options
+    may differ in opt, framepointer, max_fn_size and jtbl_instr_count.
+    """
+    options = options_list[0]
+    for other in options_list:
+        if (other.input_enc, other.output_enc, other.filename) != (options.input_enc, options.output_enc, options.filename):
+            raise Failure("all variants must have the same encodings and filename")
+    if is_plain_source(source, options.input_enc):
+        c_code = source.decode(options.input_enc).encode(options.output_enc)
+        return [(c_code, []) for _ in options_list]
+    f = StringIO(source.decode(options.input_enc), newline=None)
+    f.name = options.filename
+    outs = [StringIO() for _ in options_list]
+    for o in options_list:
+        check_jtbl_instr_count(o.opt, o.framepointer, o.jtbl_instr_count)
+    variants = [(o.opt, o.framepointer, o.max_fn_size, o.jtbl_instr_count) for o in options_list]
+    all_functions = parse_source_variants(f, variants, options.input_enc, options.output_enc, outs, jobs=options.jobs, size_probe=options.size_probe, shardable=options.assemble_shards > 1)
+    return [(out.getvalue().encode(options.output_enc), functions) for out, functions in zip(outs, all_functions)]
+
+def postprocess(obj_bytes, functions, assembler, asm_prelude=b'', output_enc='latin1', reproducible=False, assemble_shards=1, assemble_shard_size=None):
+    """
+    Post-process an object file (bytes) compiled from the output of preprocess,
+    returning the new object file contents. The assembler is run on temporary
+    files, which are removed afterwards; the input is left untouched.
+    reproducible, assemble_shards and assemble_shard_size are as for
+    --reproducible, --assemble-shards and --assemble-shard-size.
+    """
+    if functions:
+        obj_bytes = fixup_objfile_data(obj_bytes, functions, asm_prelude, assembler, output_enc, assemble_shards, assemble_shard_size)
+    if reproducible:
+        obj_bytes = make_reproducible(obj_bytes)
+    return obj_bytes
+
+class ObjectCache:
+    """
+    A directory of post-processed .o files, keyed by a hash of everything that
+    goes into building them, so that unchanged files can skip both the compile
+    and the post-processing. Entries are written atomically, so several
+    processes can share a cache. Once the total size exceeds max_size bytes,
+    the least recently used entries are removed, down to 3/4 of max_size.
+
+    The directory is only scanned on the first put, and when the size it
+    found plus what has been put since exceeds max_size, so that puts don't
+    cost time proportional to the size of the cache.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.total_size = None
+        os.makedirs(path, exist_ok=True)
+
+    def compute_key(self, args, opt, c_source, functions, asm_prelude):
+        # Returns None if the result can't be cached, because the assembly
+        # uses a file that we can't find.
+        import hashlib
+        h = hashlib.sha256()
+        def add(data):
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            h.update(struct.pack('>Q', len(data)))
+            h.update(data)
+        with open(os.path.abspath(__file__), 'rb') as f:
+            add(f.read())
+        add(repr((opt, args.framepointer, args.input_enc, args.output_enc, args.max_fn_size, args.jtbl_instr_count, args.reproducible)))
+        add(args.compiler)
+        add(args.assembler)
+        add(asm_prelude)
+        add(c_source)
+        include_lines = [line for line in asm_prelude.decode('latin1').split('\n') if '.include' in line or '.incbin' in line]
+        for function in functions:
+            hash_asm_lines(h, function.asm_conts, 'utf-8', include_lines)
+            hash_asm_lines(h, function.late_rodata_asm_conts, 'utf-8', include_lines)
+            for (_, _, path, skip, size) in function.incbins:
+                add(path)
+                with open(path, 'rb') as f:
+                    f.seek(skip)
+                    add(f.read(size))
+        # Files read by the assembler itself, i.e. .include and .incbin lines
+        # that weren't spliced in, and the files they include in turn.
+        regexes = compiled_regexes()
+        seen = set()
+        while include_lines:
+            m = regexes.include.match(include_lines.pop())
+            if m is None or m.group(2) in seen:
+                continue
+            path = m.group(2)
+            seen.add(path)
+            if not os.path.isfile(path):
+                # Probably relative to an assembler include directory.
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            add(path)
+            add(data)
+            if m.group(1) == 'include':
+                include_lines.extend(line for line in data.decode('latin1').split('\n') if '.include' in line or '.incbin' in line)
+        for dep in args.cache_deps or []:
+            add(dep)
+            with open(dep, 'rb') as f:
+                add(f.read())
+        return h.hexdigest()
+
+    def get(self, key, suffix='.o'):
+        entry = os.path.join(self.path, key + suffix)
         try:
-            os.remove(o_name)
-        except:
+            with open(entry, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            # Mark as recently used.
+            os.utime(entry)
+        except OSError:
+            # E.g. a read-only shared cache, or the entry was just evicted.
             pass
+        return data
 
-def run_wrapped(argv, outfile):
+    def put(self, key, data, suffix='.o'):
+        import tempfile
+        fd, temp_name = tempfile.mkstemp(prefix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_name, os.path.join(self.path, key + suffix))
+        except:
+            os.remove(temp_name)
+            raise
+        if self.total_size is not None:
+            self.total_size += len(data)
+        if self.total_size is None or self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, name))
+            total_size += st.st_size
+        if total_size > self.max_size:
+            entries.sort()
+            for _, size, name in entries:
+                if total_size <= self.max_size * 3 // 4:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+                total_size -= size
+        self.total_size = total_size
+
+
+def build_preprocess(args, opt, asm_prelude, block_cache=None, object_cache=None):
+    """
+    Pre-process args.filename into a temporary .c file, and look up the result
+    in the object cache. Returns the name of the .c file, the functions, the
+    cache key and the cached object file contents, if any.
+    """
+    import tempfile
+    c_file = tempfile.NamedTemporaryFile(prefix='asm-processor', suffix='.c', delete=False)
+    c_name = c_file.name
+    try:
+        with open(args.filename, encoding=args.input_enc) as f:
+            functions = parse_source(f, opt=opt, framepointer=args.framepointer, input_enc=args.input_enc, output_enc=args.output_enc, print_source=c_file, cache=block_cache, max_fn_size=args.max_fn_size, jtbl_instr_count=args.jtbl_instr_count, jobs=args.jobs, size_probe=make_size_probe(args, asm_prelude), shardable=args.assemble_shards > 1)
+        c_file.close()
+        key = None
+        data = None
+        if object_cache is not None:
+            with open(c_name, 'rb') as f:
+                key = object_cache.compute_key(args, opt, f.read(), functions, asm_prelude)
+            if key is not None:
+                data = object_cache.get(key)
+    except:
+        c_file.close()
+        os.remove(c_name)
+        raise
+    return c_name, functions, key, data
+
+def build_postprocess(args, functions, asm_prelude, key=None, object_cache=None):
+    if functions or args.reproducible:
+        fixup_objfile(args.objfile, functions, asm_prelude, args.assembler, args.output_enc, args.reproducible, args.assemble_shards, args.assemble_shard_size)
+    if object_cache is not None and key is not None:
+        with open(args.objfile, 'rb') as f:
+            object_cache.put(key, f.read())
+
+def build(args, opt, asm_prelude, block_cache=None, object_cache=None):
+    """
+    Pre-process, compile and post-process args.filename into args.objfile.
+    Returns the time spent in each stage, and whether the object cache was hit.
+    """
+    start_time = time.perf_counter()
+    c_name, functions, key, data = build_preprocess(args, opt, asm_prelude, block_cache, object_cache)
+    try:
+        preprocess_time = time.perf_counter()
+        if data is not None:
+            with open(args.objfile, 'wb') as f:
+                f.write(data)
+            return (preprocess_time - start_time, 0, 0, True)
+        ret = os.system(args.compiler + " -o " + args.objfile + " < " + c_name)
+        if ret != 0:
+            raise Failure("failed to compile")
+    finally:
+        os.remove(c_name)
+    compile_time = time.perf_counter()
+    build_postprocess(args, functions, asm_prelude, key, object_cache)
+    end_time = time.perf_counter()
+    return (preprocess_time - start_time, compile_time - preprocess_time, end_time - compile_time, False)
+
+def watch_build(args, opt, asm_prelude, cache):
+    cache.start_run()
+    preprocess_time, compile_time, postprocess_time, _ = build(args, opt, asm_prelude, block_cache=cache)
+    cache.end_run()
+    print("Rebuilt {} in {:.2f}s (pre-process {:.2f}s, {} of {} blocks reused; compile {:.2f}s; post-process {:.2f}s)".format(
+        args.objfile, preprocess_time + compile_time + postprocess_time, preprocess_time,
+        cache.hits, cache.hits + cache.misses, compile_time, postprocess_time), file=sys.stderr)
+
+def watch(args, opt):
+    # Poll the source file, its GLOBAL_ASM("file.s") sources and EARLY
+    # includes for changes, and rebuild whenever one of them is modified.
+    cache = BlockCache()
+    mtimes = None
+    while True:
+        new_mtimes = watch_mtimes(args, cache)
+        if new_mtimes != mtimes:
+            try:
+                watch_build(args, opt, read_asm_prelude(args), cache)
+            except (Failure, OSError) as e:
+                print("Error:", e, file=sys.stderr)
+            # The build may have found new dependencies. Those are up to date,
+            # but keep the old times for the rest, in case they changed during
+            # the build.
+            mtimes = watch_mtimes(args, cache)
+            mtimes.update((path, mtime) for (path, mtime) in new_mtimes.items() if path in mtimes)
+        time.sleep(0.2)
+
+def watch_mtimes(args, cache):
+    paths = {args.filename} | cache.deps
+    if args.asm_prelude:
+        paths.add(args.asm_prelude)
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+class Args:
+    # Defaults for parse_args_fast, matching those of the argparse parser.
+    filename = None
+    objfile = None
+    assembler = None
+    asm_prelude = None
+    watch = False
+    compiler = None
+    cache_dir = None
+    cache_max_size = 1024
+    cache_deps = None
+    max_fn_size = MAX_FN_SIZE
+    jtbl_instr_count = None
+    unvalidated_jtbl = False
+    jobs = 1
+    validate_sizes = False
+    variants = None
+    reproducible = False
+    probe_sizes = False
+    assemble_shards = 1
+    assemble_shard_size = MIN_ASSEMBLE_SHARD_SIZE
+    input_enc = 'latin1'
+    output_enc = 'latin1'
+    framepointer = False
+    g3 = False
+    opt = None
+
+FAST_ARG_FLAGS = {
+    '--post-process': 'objfile',
+    '--assembler': 'assembler',
+    '--asm-prelude': 'asm_prelude',
+    '--input-enc': 'input_enc',
+    '--output-enc': 'output_enc',
+}
+
+def parse_args_fast(argv):
+    # Hand-rolled parsing of the common compile.sh-style command lines, since
+    # importing argparse takes longer than pre-processing a typical file.
+    # Returns None for anything else, leaving it (and errors) to argparse.
+    args = Args()
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ['-O1', '-O2', '-g'] and args.opt is None:
+            args.opt = arg[1:]
+        elif arg == '-g3':
+            args.g3 = True
+        elif arg == '-framepointer':
+            args.framepointer = True
+        elif arg == '--reproducible':
+            args.reproducible = True
+        elif arg == '--probe-sizes':
+            args.probe_sizes = True
+        elif arg in FAST_ARG_FLAGS and i + 1 < len(argv) and not argv[i + 1].startswith('-'):
+            setattr(args, FAST_ARG_FLAGS[arg], argv[i + 1])
+            i += 1
+        elif not arg.startswith('-') and args.filename is None:
+            args.filename = arg
+        else:
+            return None
+        i += 1
+    if args.opt is None or args.filename is None:
+        return None
+    return args
+
+def parse_args(argv):
+    args = parse_args_fast(argv)
+    if args is not None:
+        return args
+    import argparse
     parser = argparse.ArgumentParser(description="Pre-process .c files and post-process .o files to enable embedding assembly into C.")
     parser.add_argument('filename', help="path to .c code")
     parser.add_argument('--post-process', dest='objfile', help="path to .o file to post-process")
     parser.add_argument('--assembler', dest='assembler', help="assembler command (e.g. \"mips-linux-gnu-as -march=vr4300 -mabi=32\")")
     parser.add_argument('--asm-prelude', dest='asm_prelude', help="path to a file containing a prelude to the assembly file (with .set and .macro directives, e.g.)")
+    parser.add_argument('--watch', action='store_true', help="keep running, and redo the compile and post-processing whenever an input changes (requires --compiler, --post-process and --assembler)")
+    parser.add_argument('--compiler', dest='compiler', help="compiler command reading C from stdin (e.g. \"cc -c -O2 include-stdin.c\"); \"-o <objfile>\" is appended. If given, asm-processor runs the compile itself, and --post-process names the output .o file")
+    parser.add_argument('--cache-dir', dest='cache_dir', help="directory for caching post-processed .o files (requires --compiler), or section sizes for --validate-sizes. WARNING: headers included with #include are not part of the cache key, so changing one can give stale objects unless it is passed with --cache-dep")
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=int, default=1024, help="maximum cache size in MiB (default: 1024)")
+    parser.add_argument('--cache-dep', dest='cache_deps', action='append', help="additional file to include in the cache key, e.g. a header; every #include'd file that can change must be listed (may be repeated)")
+    parser.add_argument('--max-fn-size', dest='max_fn_size', type=int, default=MAX_FN_SIZE, help="split generated C functions after this many instructions; smaller functions are cheaper for IDO to optimize (default: {}, minimum: {})".format(MAX_FN_SIZE, MIN_MAX_FN_SIZE))
+    parser.add_argument('--jtbl-instr-count', dest='jtbl_instr_count', type=int, help="generate late rodata using jump tables, assuming that a switch statement compiles to this many instructions; must match the known count for the flags unless --unvalidated-jtbl is given (default: jump tables with 9 instructions for -O2 and -O2 -g3 without -framepointer, else none; see find-jtbl-instr-count.sh)")
+    parser.add_argument('--unvalidated-jtbl', dest='unvalidated_jtbl', action='store_true', help="allow any --jtbl-instr-count, for finding the count for new flags")
+    parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=1, help="number of processes to use for parsing GLOBAL_ASM blocks (default: 1)")
+    parser.add_argument('--validate-sizes', dest='validate_sizes', action='store_true', help="when pre-processing, check computed section sizes by assembling each GLOBAL_ASM block (requires --assembler and --asm-prelude)")
+    parser.add_argument('--variant', dest='variants', action='append', metavar='OUTFILE=FLAGS', help="when pre-processing, also write the C code for other flags to OUTFILE, parsing the source only once, e.g. \"file.g.c=-g -framepointer\" (may be repeated)")
+    parser.add_argument('--reproducible', dest='reproducible', action='store_true', help="when post-processing, make the output independent of paths and symbol merge order, for sharing build caches between checkouts")
+    parser.add_argument('--probe-sizes', dest='probe_sizes', action='store_true', help="allow macro calls and pseudo-instructions in GLOBAL_ASM by assembling them to find their sizes, caching the results in --cache-dir if given (requires --assembler, also when pre-processing)")
+    parser.add_argument('--assemble-shards', dest='assemble_shards', type=int, default=1, help="when post-processing, split the assembly into up to this many parts and assemble them in parallel; the output is unaffected (default: 1)")
+    parser.add_argument('--assemble-shard-size', dest='assemble_shard_size', type=int, default=MIN_ASSEMBLE_SHARD_SIZE, metavar='BYTES', help="minimum size of the parts for --assemble-shards (default: {})".format(MIN_ASSEMBLE_SHARD_SIZE))
     parser.add_argument('--input-enc', default='latin1', help="Input encoding (default: latin1)")
     parser.add_argument('--output-enc', default='latin1', help="Output encoding (default: latin1)")
     parser.add_argument('-framepointer', dest='framepointer', action='store_true')
@@ -1115,28 +3067,345 @@ def run_wrapped(argv, outfile):
     group.add_argument('-O1', dest='opt', action='store_const', const='O1')
     group.add_argument('-O2', dest='opt', action='store_const', const='O2')
     group.add_argument('-g', dest='opt', action='store_const', const='g')
-    args = parser.parse_args(argv)
+    return parser.parse_args(argv)
+
+def check_args(args):
+    # Validates the parsed arguments, and returns the optimization level.
     opt = args.opt
     if args.g3:
         if opt != 'O2':
             raise Failure("-g3 is only supported together with -O2")
         opt = 'g3'
 
-    if args.objfile is None:
+    if args.cache_dir is not None and args.compiler is None and not args.validate_sizes and not args.probe_sizes:
+        raise Failure("--cache-dir requires --compiler, --validate-sizes or --probe-sizes")
+
+    if args.probe_sizes and args.assembler is None:
+        raise Failure("--probe-sizes requires --assembler")
+
+    if args.validate_sizes and args.asm_prelude is None:
+        # The blocks, and the labels used for measuring them, need glabel.
+        raise Failure("--validate-sizes requires --asm-prelude")
+
+    if args.max_fn_size < MIN_MAX_FN_SIZE:
+        raise Failure("--max-fn-size must be at least {}".format(MIN_MAX_FN_SIZE))
+
+    if args.jobs < 1:
+        raise Failure("--jobs must be positive")
+
+    if args.assemble_shards < 1:
+        raise Failure("--assemble-shards must be positive")
+
+    if args.assemble_shard_size < 1:
+        raise Failure("--assemble-shard-size must be positive")
+
+    if args.jtbl_instr_count is not None and args.jtbl_instr_count < 1:
+        raise Failure("--jtbl-instr-count must be positive")
+
+    if not args.unvalidated_jtbl:
+        check_jtbl_instr_count(opt, args.framepointer, args.jtbl_instr_count)
+
+    if args.variants and (args.objfile is not None or args.compiler is not None or args.validate_sizes):
+        raise Failure("--variant is only supported when pre-processing")
+
+    return opt
+
+def parse_variant(args, flags):
+    # Returns the parse_source_variants variant for the flags of a --variant.
+    import shlex
+    variant_args = parse_args(shlex.split(flags) + [args.filename])
+    opt = check_args(variant_args)
+    return (opt, variant_args.framepointer, variant_args.max_fn_size, variant_args.jtbl_instr_count)
+
+def read_asm_prelude(args):
+    if not args.asm_prelude:
+        return b''
+    with open(args.asm_prelude, 'rb') as f:
+        return f.read()
+
+def open_object_cache(args):
+    if args.cache_dir is None:
+        return None
+    return ObjectCache(args.cache_dir, args.cache_max_size * 1024 * 1024)
+
+def make_size_probe(args, asm_prelude):
+    if not args.probe_sizes:
+        return None
+    return SizeProbe(args.assembler, asm_prelude, args.output_enc, open_object_cache(args))
+
+def schedule_preprocess(argv):
+    # Pre-process stage of schedule(), run in a worker process. Returns None
+    # if the object file was found in the cache.
+    args = parse_args(argv)
+    opt = check_args(args)
+    c_name, functions, key, data = build_preprocess(args, opt, read_asm_prelude(args), object_cache=open_object_cache(args))
+    if data is not None:
+        os.remove(c_name)
+        with open(args.objfile, 'wb') as f:
+            f.write(data)
+        return None
+    return c_name, functions, key
+
+def schedule_postprocess(batch, max_batch):
+    # Post-process stage of schedule(), run in a worker process, for a list of
+    # (argv, functions, key) tuples. Files with the same assembler and prelude
+    # share assembler runs. Returns an exception or None for each file.
+    results = [None] * len(batch)
+    groups = {}
+    for ind, (argv, functions, key) in enumerate(batch):
+        args = parse_args(argv)
+        try:
+            asm_prelude = read_asm_prelude(args)
+            with open(args.objfile, 'rb') as f:
+                objfile_data = f.read()
+        except OSError as e:
+            results[ind] = e
+            continue
+        group = groups.setdefault((args.assembler, asm_prelude, args.output_enc, args.assemble_shards, args.assemble_shard_size), [])
+        group.append((ind, args, key, objfile_data, functions))
+    for (assembler, asm_prelude, output_enc, assemble_shards, assemble_shard_size), group in groups.items():
+        shared = []
+        outputs = postprocess_batch([(objfile_data, functions) for (_, _, _, objfile_data, functions) in group],
+                assembler, asm_prelude, output_enc, max_batch, assemble_shards, shared, assemble_shard_size)
+        for (ind, args, key, _, _), objfile_data, was_shared in zip(group, outputs, shared):
+            if isinstance(objfile_data, Failure):
+                results[ind] = objfile_data
+                continue
+            try:
+                if args.reproducible:
+                    objfile_data = make_reproducible(objfile_data)
+                with open(args.objfile, 'wb') as f:
+                    f.write(objfile_data)
+                # Outputs of shared assembler runs aren't cached, in case
+                # they depend on the other files after all.
+                object_cache = open_object_cache(args)
+                if object_cache is not None and key is not None and not was_shared:
+                    object_cache.put(key, objfile_data)
+            except (Failure, OSError) as e:
+                results[ind] = e
+    return results
+
+class PostprocessBatcher:
+    """
+    Collects files waiting for post-processing in schedule(), and hands them
+    to up to `jobs` workers, up to `batch_size` at a time. Files are batched
+    only while all workers are busy, including with pre-processing (see
+    preprocess), so this never delays a file.
+    """
+    def __init__(self, executor, jobs, batch_size):
+        self.executor = executor
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.running = 0
+        self.pending = []
+
+    async def preprocess(self, argv):
+        # Run schedule_preprocess on the shared executor, counting it as a
+        # busy worker.
+        import asyncio
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, schedule_preprocess, argv)
+        finally:
+            self.running -= 1
+            self.flush()
+
+    async def postprocess(self, argv, functions, key):
+        import asyncio
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((argv, functions, key, future))
+        self.flush()
+        await future
+
+    def flush(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while self.pending and self.running < self.jobs:
+            batch = self.pending[:self.batch_size]
+            self.pending = self.pending[self.batch_size:]
+            self.running += 1
+            task = loop.run_in_executor(self.executor, schedule_postprocess,
+                    [(argv, functions, key) for (argv, functions, key, _) in batch], self.batch_size)
+            task.add_done_callback(lambda task, batch=batch: self.done(task, batch))
+
+    def done(self, task, batch):
+        self.running -= 1
+        if task.exception() is not None:
+            results = [task.exception()] * len(batch)
+        else:
+            results = task.result()
+        for (_, _, _, future), res in zip(batch, results):
+            if res is None:
+                future.set_result(None)
+            else:
+                future.set_exception(res)
+        self.flush()
+
+async def schedule_one(argv, args, semaphores, batcher):
+    import asyncio
+    preprocess_sem, compile_sem = semaphores
+    async with preprocess_sem:
+        res = await batcher.preprocess(argv)
+    if res is None:
+        return
+    c_name, functions, key = res
+    try:
+        async with compile_sem:
+            proc = await asyncio.create_subprocess_shell(args.compiler + " -o " + args.objfile + " < " + c_name)
+            ret = await proc.wait()
+    finally:
+        os.remove(c_name)
+    if ret != 0:
+        raise Failure("failed to compile")
+    await batcher.postprocess(argv, functions, key)
+
+async def schedule(commands, jobs, compile_jobs, batch_assemble=1):
+    """
+    Build several files, given as (argv, args) pairs of --compiler mode
+    command lines. Pre-processing and post-processing run in up to `jobs`
+    worker processes, and up to `compile_jobs` compiles run at the same time,
+    so that the stages of different files overlap. With batch_assemble > 1,
+    files waiting for post-processing share assembler runs, up to that many
+    at a time (see postprocess_batch). Returns the number of files that
+    failed to build.
+    """
+    import asyncio
+    import concurrent.futures
+    # Start with the largest files, so they don't end up alone at the end of the build.
+    def source_size(command):
+        try:
+            return os.path.getsize(command[1].filename)
+        except OSError:
+            # Reported when pre-processing it, like other input errors.
+            return 0
+    commands = sorted(commands, key=source_size, reverse=True)
+    semaphores = (asyncio.Semaphore(jobs), asyncio.Semaphore(compile_jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        batcher = PostprocessBatcher(executor, jobs, batch_assemble)
+        results = await asyncio.gather(*[schedule_one(argv, args, semaphores, batcher) for (argv, args) in commands], return_exceptions=True)
+    failures = 0
+    for (_, args), res in zip(commands, results):
+        if isinstance(res, (Failure, OSError)):
+            print("Error:", args.objfile + ":", res, file=sys.stderr)
+            failures += 1
+        elif res is not None:
+            raise res
+    return failures
+
+def run_schedule(argv):
+    import argparse
+    import asyncio
+    import shlex
+    parser = argparse.ArgumentParser(prog="asm_processor.py --schedule", description="Build several files, overlapping the pre-processing, compiling and post-processing of different files.")
+    parser.add_argument('manifest', help="file with one asm-processor command line per line, each using --compiler, --post-process and --assembler")
+    parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=os.cpu_count(), help="number of processes for pre- and post-processing (default: number of CPUs)")
+    parser.add_argument('--compile-jobs', dest='compile_jobs', type=int, default=os.cpu_count(), help="number of compiles to run at the same time (default: number of CPUs)")
+    parser.add_argument('--batch-assemble', dest='batch_assemble', type=int, default=1, help="let up to this many files share an assembler run when post-processing (default: 1)")
+    sargs = parser.parse_args(argv)
+    if sargs.jobs < 1 or sargs.compile_jobs < 1 or sargs.batch_assemble < 1:
+        raise Failure("--jobs, --compile-jobs and --batch-assemble must be positive")
+
+    commands = []
+    with open(sargs.manifest) as f:
+        for line_no, line in enumerate(f, 1):
+            cmd = shlex.split(line, comments=True)
+            if not cmd:
+                continue
+            args = parse_args(cmd)
+            try:
+                check_args(args)
+                if args.watch or args.compiler is None or args.objfile is None or args.assembler is None:
+                    raise Failure("each command must use --compiler, --post-process and --assembler, and not --watch")
+            except Failure as e:
+                raise Failure("{}:{}: {}".format(sargs.manifest, line_no, e))
+            commands.append((cmd, args))
+
+    failures = asyncio.run(schedule(commands, sargs.jobs, sargs.compile_jobs, sargs.batch_assemble))
+    if failures:
+        raise Failure("failed to build {} of {} files".format(failures, len(commands)))
+
+def run_wrapped(argv, outfile):
+    if argv[:1] == ['--schedule']:
+        run_schedule(argv[1:])
+        return
+
+    args = parse_args(argv)
+    opt = check_args(args)
+
+    if args.watch:
+        if args.compiler is None or args.objfile is None or args.assembler is None:
+            raise Failure("--watch requires --compiler, --post-process and --assembler")
+        try:
+            watch(args, opt)
+        except KeyboardInterrupt:
+            pass
+    elif args.compiler is not None:
+        if args.objfile is None or args.assembler is None:
+            raise Failure("--compiler requires --post-process and --assembler")
+        build(args, opt, read_asm_prelude(args), object_cache=open_object_cache(args))
+    elif args.objfile is None and args.validate_sizes:
+        if args.assembler is None:
+            raise Failure("--validate-sizes requires --assembler")
+        asm_prelude = read_asm_prelude(args)
+        object_cache = open_object_cache(args)
+        # Validate before writing anything, so that the compiler doesn't run
+        # on the output in case of a failure.
+        out = StringIO()
+        variant = (opt, args.framepointer, args.max_fn_size, args.jtbl_instr_count)
         with open(args.filename, encoding=args.input_enc) as f:
-            parse_source(f, opt=opt, framepointer=args.framepointer, input_enc=args.input_enc, output_enc=args.output_enc, print_source=outfile)
+            functions = parse_source_variants(f, [variant], args.input_enc, args.output_enc, [out], jobs=args.jobs, size_probe=make_size_probe(args, asm_prelude))[0]
+        validate_sizes(functions, asm_prelude, args.assembler, args.output_enc, args.jobs, object_cache)
+        outfile.write(out.getvalue().encode(args.output_enc))
+        outfile.flush()
+        if outfile != sys.stdout.buffer:
+            outfile.close()
+    elif args.objfile is None:
+        variants = [(opt, args.framepointer, args.max_fn_size, args.jtbl_instr_count)]
+        variant_names = []
+        for variant in args.variants or []:
+            name, eq, flags = variant.partition('=')
+            if not eq:
+                raise Failure("--variant must be of the form OUTFILE=FLAGS")
+            variants.append(parse_variant(args, flags))
+            variant_names.append(name)
+        with open(args.filename, 'rb') as f, map_source(f) as data:
+            if is_plain_source(data, args.input_enc):
+                if args.input_enc != args.output_enc:
+                    data = bytes(data).decode(args.input_enc).encode(args.output_enc)
+                if data and data[-1:] != b'\n':
+                    data = bytes(data) + b'\n'
+                outfile.write(data)
+                outfile.flush()
+                if outfile != sys.stdout.buffer:
+                    outfile.close()
+                for name in variant_names:
+                    with open(name, 'wb') as out:
+                        out.write(data)
+                return
+        variant_outs = []
+        try:
+            for name in variant_names:
+                variant_outs.append(open(name, 'wb'))
+            with open(args.filename, encoding=args.input_enc) as f:
+                parse_source_variants(f, variants, args.input_enc, args.output_enc, [outfile] + variant_outs, jobs=args.jobs, size_probe=make_size_probe(args, read_asm_prelude(args)))
+            if outfile != sys.stdout.buffer:
+                outfile.close()
+        finally:
+            for out in variant_outs:
+                out.close()
     else:
         if args.assembler is None:
             raise Failure("must pass assembler command")
-        with open(args.filename, encoding=args.input_enc) as f:
-            functions = parse_source(f, opt=opt, framepointer=args.framepointer, input_enc=args.input_enc, output_enc=args.output_enc)
-        if not functions:
+        functions = []
+        with open(args.filename, 'rb') as f, map_source(f) as data:
+            is_plain = is_plain_source(data, args.input_enc)
+        asm_prelude = read_asm_prelude(args)
+        if not is_plain:
+            with open(args.filename, encoding=args.input_enc) as f:
+                functions = parse_source(f, opt=opt, framepointer=args.framepointer, input_enc=args.input_enc, output_enc=args.output_enc, max_fn_size=args.max_fn_size, jtbl_instr_count=args.jtbl_instr_count, jobs=args.jobs, size_probe=make_size_probe(args, asm_prelude), shardable=args.assemble_shards > 1)
+        if not functions and not args.reproducible:
             return
-        asm_prelude = b''
-        if args.asm_prelude:
-            with open(args.asm_prelude, 'rb') as f:
-                asm_prelude = f.read()
-        fixup_objfile(args.objfile, functions, asm_prelude, args.assembler, args.output_enc)
+        fixup_objfile(args.objfile, functions, asm_prelude, args.assembler, args.output_enc, args.reproducible, args.assemble_shards, args.assemble_shard_size)
 
 def run(argv, outfile=sys.stdout.buffer):
     try:
@@ -0,0 +1,24 @@
+#!/usr/bin/env bash
+# Compares compile times for the test corpus between the default generated C
+# and smaller generated functions (--max-fn-size), for every supported flag
+# combination. Both must give identical objects; mismatches are reported.
+# Usage: ./benchmark-compile.sh [max-fn-size]
+SIZE="${1:-30}"
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+for FLAGS in "-g" "-g -framepointer" "-O1" "-O1 -framepointer" "-O2" "-O2 -framepointer" "-O2 -g3"; do
+    BASE_TIME=0
+    NEW_TIME=0
+    for A in tests/*.c; do
+        B=$(basename "${A%.c}")
+        START=$(date +%s%N)
+        OPTFLAGS="$FLAGS" OUTPUT="$TMP/$B.base.o" ./compile.sh "$A" > /dev/null 2>&1 || { echo "SKIP $A ($FLAGS)"; continue; }
+        MID=$(date +%s%N)
+        OPTFLAGS="$FLAGS" ASMP_FLAGS="--max-fn-size $SIZE" OUTPUT="$TMP/$B.new.o" ./compile.sh "$A" > /dev/null 2>&1 || { echo "FAIL $A ($FLAGS)"; continue; }
+        END=$(date +%s%N)
+        BASE_TIME=$((BASE_TIME + MID - START))
+        NEW_TIME=$((NEW_TIME + END - MID))
+        cmp -s "$TMP/$B.base.o" "$TMP/$B.new.o" || echo "MISMATCH $A ($FLAGS)"
+    done
+    echo "$FLAGS: default $((BASE_TIME / 1000000)) ms, --max-fn-size $SIZE $((NEW_TIME / 1000000)) ms"
+done
@@ -0,0 +1,47 @@
+#!/usr/bin/env bash
+# Measures the time spent generating C for many small GLOBAL_ASM blocks of a
+# few repeated shapes (GlobalAsmBlock.finish), with and without reuse of the
+# generated C between blocks of the same shape, as well as the total
+# pre-processing time for a file with those blocks. Both settings must give
+# identical output; a mismatch is reported.
+# Usage: ./benchmark-preprocess.sh [blocks] [runs]
+python3 - "${1:-5000}" "${2:-5}" <<'EOF'
+import sys, time
+import asm_processor
+
+num_blocks = int(sys.argv[1])
+runs = int(sys.argv[2])
+blocks = []
+for i in range(num_blocks):
+    lines = ["glabel func_{}".format(i)] + ["nop"] * [8, 12, 40, 150][i % 4]
+    if i % 3 == 0:
+        lines += [".late_rodata", ".word 1", ".word 2"]
+    if i % 5 == 0:
+        lines += [".rdata", ".word 1"]
+    blocks.append(lines)
+source = "".join("GLOBAL_ASM(\n" + "\n".join(lines) + "\n)\nint c_func_{}(void) {{ return 0; }}\n".format(i)
+        for i, lines in enumerate(blocks)).encode('latin1')
+parsed = [asm_processor.process_block_lines("block", lines, 'latin1') for lines in blocks]
+
+def measure(cache_size):
+    asm_processor.FINISH_TEMPLATE_CACHE_SIZE = cache_size
+    finish_best = total_best = None
+    for _ in range(runs):
+        state = asm_processor.make_global_state('O2', False)
+        start = time.perf_counter()
+        srcs = [block.finish(state)[0] for block in parsed]
+        finish_time = time.perf_counter() - start
+        start = time.perf_counter()
+        c_code, _ = asm_processor.preprocess(source, asm_processor.Options('O2'))
+        total_time = time.perf_counter() - start
+        finish_best = finish_time if finish_best is None else min(finish_best, finish_time)
+        total_best = total_time if total_best is None else min(total_best, total_time)
+    return finish_best, total_best, (srcs, c_code)
+
+no_reuse = measure(0)
+reuse = measure(256)
+print("{} blocks: finish {:.0f} ms without template reuse, {:.0f} ms with".format(num_blocks, no_reuse[0] * 1000, reuse[0] * 1000))
+print("{} blocks: pre-processing {:.0f} ms without template reuse, {:.0f} ms with".format(num_blocks, no_reuse[1] * 1000, reuse[1] * 1000))
+if no_reuse[2] != reuse[2]:
+    print("MISMATCH between outputs")
+EOF
@@ -0,0 +1,39 @@
+#!/usr/bin/env bash
+# Measures asm-processor's startup cost: the time spent importing modules
+# (from python -X importtime) and the wall-clock time per invocation, for a
+# plain C file and for one with GLOBAL_ASM blocks. If MAX_IMPORT_US is set,
+# exits with an error when importing for the plain file takes longer than that.
+# Usage: ./benchmark-startup.sh [runs]
+RUNS="${1:-50}"
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+printf 'int x = 1;\nint f(void) { return x; }\n' > "$TMP/plain.c"
+python3 -m compileall -q asm_processor.py
+
+import_us() {
+    # Sum of self times of all modules imported on top of a bare interpreter.
+    python3 -X importtime -m asm_processor -O2 "$1" 2>&1 > /dev/null \
+        | awk -F'|' '/^import time: *[0-9]/ { sub(/import time: */, "", $1); t += $1 } END { print t }'
+}
+run_ms() {
+    START=$(date +%s%N)
+    for ((i = 0; i < RUNS; i++)); do
+        python3 -m asm_processor -O2 "$1" > /dev/null
+    done
+    END=$(date +%s%N)
+    echo $(((END - START) / RUNS / 1000))
+}
+
+BASE_US=$(python3 -X importtime -c pass 2>&1 \
+    | awk -F'|' '/^import time: *[0-9]/ { sub(/import time: */, "", $1); t += $1 } END { print t }')
+PLAIN_US=$(($(import_us "$TMP/plain.c") - BASE_US))
+ASM_US=$(($(import_us tests/test1.c) - BASE_US))
+echo "imports: plain file ${PLAIN_US} us, GLOBAL_ASM file ${ASM_US} us"
+echo "per run: plain file $(run_ms "$TMP/plain.c") us, GLOBAL_ASM file $(run_ms tests/test1.c) us"
+echo "slowest imports (GLOBAL_ASM file, cumulative us):"
+python3 -X importtime -m asm_processor -O2 tests/test1.c 2>&1 > /dev/null \
+    | awk -F'|' '/^import time: *[0-9]/ { print $2 "|" $3 }' | sort -n -r | head -5
+if [[ -n "$MAX_IMPORT_US" && "$PLAIN_US" -gt "$MAX_IMPORT_US" ]]; then
+    echo "FAIL: imports for a plain file take ${PLAIN_US} us (limit ${MAX_IMPORT_US} us)"
+    exit 1
+fi
@@ -0,0 +1,20 @@
+#!/usr/bin/env bash
+# Builds each test twice with --reproducible, from copies of the repository at
+# two different paths, and checks that the object files are identical.
+# Should exit without output if they are.
+# Usage: ./check-reproducible.sh
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+DIRS=("$TMP/a" "$TMP/another/checkout")
+for DIR in "${DIRS[@]}"; do
+    mkdir -p "$DIR"
+    cp -r asm_processor.py compile.sh prelude.s include-stdin.c tests "$DIR"
+done
+for A in tests/*.c; do
+    HASHES=()
+    for DIR in "${DIRS[@]}"; do
+        (cd "$DIR" && ASMP_FLAGS="--reproducible $ASMP_FLAGS" OUTPUT="${A%.c}.o" TMPDIR="$DIR" ./compile.sh "$A") || { echo FAIL "$A"; continue 2; }
+        HASHES+=("$(sha256sum < "$DIR/${A%.c}.o")")
+    done
+    [[ "${HASHES[0]}" == "${HASHES[1]}" ]] || echo NOT REPRODUCIBLE "$A"
+done
@@ -2,18 +2,33 @@
 set -e
 set -o pipefail
 INPUT="$1"
-OUTPUT="${INPUT%.c}.o"
+OUTPUT="${OUTPUT:-${INPUT%.c}.o}"
 
 CC="$QEMU_IRIX -silent -L $IRIX_ROOT $IRIX_ROOT/usr/bin/cc"
 CFLAGS="-Wab,-r4300_mul -non_shared -G 0 -Xcpluscomm -fullwarn -wlint -woff 819,820,852,821 -signed -DVERSION_JP=1 -mips2" # -I include
 AS="mips-linux-gnu-as"
 ASFLAGS="-march=vr4300 -mabi=32 --defsym VERSION_JP=1" # -I include
-set +e
-OPTFLAGS=$(grep '^// COMPILE-FLAGS: ' $INPUT | sed 's#^// COMPILE-FLAGS: ##')
-set -e
+if [[ -z "$OPTFLAGS" ]]; then
+    set +e
+    OPTFLAGS=$(grep '^// COMPILE-FLAGS: ' $INPUT | sed 's#^// COMPILE-FLAGS: ##')
+    set -e
+fi
 if [[ -z "$OPTFLAGS" ]]; then
     OPTFLAGS="-g"
 fi
 
-python3 asm_processor.py "$OPTFLAGS" "$INPUT" | $CC -c $CFLAGS include-stdin.c -o "$OUTPUT" "$OPTFLAGS"
-python3 asm_processor.py "$OPTFLAGS" "$INPUT" --post-process "$OUTPUT" --assembler "$AS $ASFLAGS" --asm-prelude prelude.s
+ASMP_FLAGS="$(grep '^// ASMP-FLAGS: ' "$INPUT" | sed 's#^// ASMP-FLAGS: ##' || true) $ASMP_FLAGS"
+
+read -ra OPTS <<< "$OPTFLAGS"
+read -ra ASMP_OPTS <<< "$ASMP_FLAGS"
+
+if [[ -n "$SCHEDULE" ]]; then
+    # Print a command line for python3 -m asm_processor --schedule instead.
+    printf '%q ' "${OPTS[@]}" "${ASMP_OPTS[@]}" "$INPUT" --post-process "$OUTPUT" \
+        --compiler "$CC -c $CFLAGS include-stdin.c ${OPTS[*]}" --assembler "$AS $ASFLAGS" --asm-prelude prelude.s
+    echo
+    exit 0
+fi
+
+python3 -m asm_processor "${OPTS[@]}" "${ASMP_OPTS[@]}" "$INPUT" --assembler "$AS $ASFLAGS" --asm-prelude prelude.s | $CC -c $CFLAGS include-stdin.c -o "$OUTPUT" "${OPTS[@]}"
+python3 -m asm_processor "${OPTS[@]}" "${ASMP_OPTS[@]}" "$INPUT" --post-process "$OUTPUT" --assembler "$AS $ASFLAGS" --asm-prelude prelude.s
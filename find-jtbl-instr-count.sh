@@ -0,0 +1,39 @@
+#!/usr/bin/env bash
+# Works out how many instructions IDO emits for the switch statements used to
+# generate late rodata jump tables, for the flag combinations where
+# asm-processor doesn't use them by default. For each combination, builds the
+# late rodata tests without jump tables, then with --jtbl-instr-count N for a
+# range of N, and reports the values of N that give identical objects for all
+# tests. Once one of those has been checked, add it to JTBL_INSTR_COUNTS in
+# asm_processor.py.
+# Usage: ./find-jtbl-instr-count.sh [min] [max]
+MIN="${1:-5}"
+MAX="${2:-20}"
+TMP=$(mktemp -d)
+trap 'rm -rf "$TMP"' EXIT
+for FLAGS in "-g" "-g -framepointer" "-O1" "-O1 -framepointer" "-O2 -framepointer"; do
+    TESTS=()
+    for A in tests/late_rodata*.c; do
+        B=$(basename "${A%.c}")
+        if OPTFLAGS="$FLAGS" OUTPUT="$TMP/$B.ref.o" ./compile.sh "$A" > /dev/null 2>&1; then
+            TESTS+=("$A")
+        fi
+    done
+    GOOD=()
+    for ((N = MIN; N <= MAX; N++)); do
+        USED=0
+        OK=1
+        for A in "${TESTS[@]}"; do
+            B=$(basename "${A%.c}")
+            if python3 -m asm_processor $FLAGS --unvalidated-jtbl --jtbl-instr-count $N "$A" 2> /dev/null | grep -q switch; then
+                USED=1
+            fi
+            OPTFLAGS="$FLAGS" ASMP_FLAGS="--unvalidated-jtbl --jtbl-instr-count $N" OUTPUT="$TMP/$B.jtbl.o" ./compile.sh "$A" > /dev/null 2>&1 \
+                && cmp -s "$TMP/$B.ref.o" "$TMP/$B.jtbl.o" || { OK=0; break; }
+        done
+        if [[ $USED == 1 && $OK == 1 ]]; then
+            GOOD+=($N)
+        fi
+    done
+    echo "$FLAGS: ${GOOD[*]:-no working instruction count}"
+done
@@ -6,3 +6,8 @@
     \label:
 .endm
 
+.macro nops count
+    .rept \count
+    nop
+    .endr
+.endm
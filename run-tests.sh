@@ -2,3 +2,50 @@
 for A in tests/*.c; do
     ./compile.sh "$A" && mips-linux-gnu-objdump -s "${A%.c}.o" | diff - "${A%.c}.objdump" || echo FAIL "$A"
 done
+# --reproducible drops debug info and the directories of file symbols, which
+# objdump -s doesn't show.
+mips-linux-gnu-readelf -S -s tests/reproducible.o | grep -qE 'MIPS_DEBUG|FILE.*/' && echo FAIL tests/reproducible.c --reproducible
+# --max-fn-size only changes how the generated C is split into functions, so
+# the objects must match the same expected output.
+for A in tests/*.c; do
+    OUTPUT="${A%.c}.split.o" ASMP_FLAGS="--max-fn-size 20" ./compile.sh "$A" && mips-linux-gnu-objdump -s "${A%.c}.split.o" | sed 's#\.split\.o:#.o:#' | diff - "${A%.c}.objdump" || echo FAIL "$A" --max-fn-size
+    rm -f "${A%.c}.split.o"
+done
+# Splitting functions must not separate a jump table dispatch from the
+# instruction in its delay slot, even when it ends right at --max-fn-size.
+python3 -m asm_processor -O2 --unvalidated-jtbl --jtbl-instr-count 17 --max-fn-size 20 tests/late_rodata_jtbl.c \
+    | awk '/switch/ { n = NR + 17 } NR == n && !/^\*\(volatile int\*\)0 = 0;$/ { bad = 1 } END { exit bad }' \
+    || echo FAIL tests/late_rodata_jtbl.c --max-fn-size with a jump table
+# --assemble-shards assembles parts of the file separately and merges them,
+# which must give the same object as a single assembler run.
+for N in 2 3; do
+    OUTPUT=tests/large.shards.o ASMP_FLAGS="--assemble-shards $N --assemble-shard-size 64" ./compile.sh tests/large.c && mips-linux-gnu-objdump -s tests/large.shards.o | sed 's#\.shards\.o:#.o:#' | diff - tests/large.objdump || echo FAIL tests/large.c --assemble-shards $N
+    rm -f tests/large.shards.o
+done
+# --variant writes the C code for other flags from a single parse, which must
+# match pre-processing with those flags directly.
+TMP=$(mktemp -d)
+for A in tests/*.c; do
+    FLAGS=$(grep '^// COMPILE-FLAGS: ' "$A" | sed 's#^// COMPILE-FLAGS: ##')
+    read -ra OPTS <<< "${FLAGS:--g}"
+    for VARIANT in "-g" "-g -framepointer" "-O1" "-O2" "-O2 -framepointer" "-O2 -g3"; do
+        read -ra VOPTS <<< "$VARIANT"
+        python3 -m asm_processor "${VOPTS[@]}" "$A" > "$TMP/expected.c" 2> /dev/null || continue
+        python3 -m asm_processor "${OPTS[@]}" "$A" --variant "$TMP/variant.c=$VARIANT" > "$TMP/main.c" \
+            && python3 -m asm_processor "${OPTS[@]}" "$A" | cmp -s - "$TMP/main.c" \
+            && cmp -s "$TMP/expected.c" "$TMP/variant.c" || echo FAIL "$A" --variant "$VARIANT"
+    done
+done
+rm -rf "$TMP"
+# Files post-processed together with --batch-assemble must give the same
+# objects as on their own.
+TMP=$(mktemp -d)
+for A in tests/*.c; do
+    OUTPUT="$TMP/$(basename "${A%.c}").o" SCHEDULE=1 ./compile.sh "$A"
+done > "$TMP/manifest"
+python3 -m asm_processor --schedule "$TMP/manifest" --jobs 1 --batch-assemble 8 || echo FAIL --batch-assemble
+for A in tests/*.c; do
+    B=$(basename "${A%.c}")
+    mips-linux-gnu-objdump -s "$TMP/$B.o" | sed "s#^$TMP/#tests/#" | diff - "${A%.c}.objdump" || echo FAIL "$A" --batch-assemble
+done
+rm -rf "$TMP"
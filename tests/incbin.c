@@ -0,0 +1,29 @@
+GLOBAL_ASM(
+.rdata
+.incbin "tests/incbin.bin", 2, 4
+.word 0x11223344
+.incbin "tests/incbin.bin", 6, 4
+)
+
+GLOBAL_ASM(
+.late_rodata
+.incbin "tests/incbin.bin", 6, 4
+.text
+glabel incbin_late
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    nop
+    jr $ra
+    nop
+)
@@ -0,0 +1,13 @@
+// ASMP-FLAGS: --probe-sizes
+GLOBAL_ASM(
+.text
+glabel probe_macros
+    li $v0, 0x12345678
+    li $v1, 1
+    la $a0, probe_macros
+    nops 3
+    jr $ra
+    nop
+)
+
+void after_probe_macros(void) {}
@@ -0,0 +1,14 @@
+// ASMP-FLAGS: --reproducible
+GLOBAL_ASM(
+.rdata
+glabel zeta_rodata
+.word 0x1212
+alpha_local:
+.word alpha_local
+.text
+glabel beta_text
+lui $v0, %hi(zeta_rodata)
+lw $v0, %lo(zeta_rodata)($v0)
+jr $ra
+nop
+)